@@ -0,0 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+from gql import gql
+import json
+import os
+import threading
+
+
+class ExistenceChecker:
+    '''
+    ExistenceChecker finds which keys, e.g. slugs or YouTube ids, already exist in a list of the CMS.
+    The keys are queried in chunks of chunk_size concurrently instead of one giant OR filter.
+
+    The chunks are queried by one pool of parallelism workers kept by the checker, every worker creates its client once.
+    close shuts the pool down when the checker is no longer used.
+
+    With an index_path, it keeps an index of all the keys of the list, saved to the local file and to gs://gcs_bucket/index_path.
+    The index is refreshed incrementally by paging through the items after the indexed ones in id order, and rebuilt when an indexed item
+    has been deleted, so the existence of every key is answered locally.
+    '''
+
+    def __init__(self, create_client, list_name: str, key_field: str, condition, where: str = None, to_key=None,
+                 chunk_size: int = 50, parallelism: int = 4, page_size: int = 500, index_path: str = None, gcs_bucket: str = None):
+        '''
+        create_client creates the authenticated client used by a worker thread, gql clients are not thread-safe.
+        condition formats the where filter matching a chunk of keys, and to_key converts the key_field of an item to its key.
+        where is the filter of all the items to index and check.
+        '''
+        self.create_client = create_client
+        self.list_name = list_name
+        self.key_field = key_field
+        self.condition = condition
+        self.where = where
+        self.to_key = to_key if to_key is not None else (lambda value: value)
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+        self.page_size = page_size
+        self.index_path = index_path
+        self.gcs_bucket = gcs_bucket
+        self.local = threading.local()
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.reset_index()
+        self.indexed = False
+        self.load()
+
+    def get_client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.create_client()
+        return self.local.client
+
+    def get_bucket(self):
+        # google-cloud-storage is only required when the index is backed by GCS
+        from common import gcs
+        return gcs.get_publisher().client.bucket(self.gcs_bucket)
+
+    def reset_index(self):
+        self.keys = set()
+        self.count = 0
+        self.last_id = None
+
+    def load(self):
+        if self.index_path is None:
+            return
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        elif self.gcs_bucket:
+            blob = self.get_bucket().get_blob(self.index_path)
+            index = json.loads(blob.download_as_bytes().decode(
+                'utf-8')) if blob is not None else None
+        else:
+            index = None
+
+        if index is not None:
+            self.keys = set(index['keys'])
+            self.count = index['count']
+            self.last_id = index['lastId']
+
+    def save(self):
+        if self.index_path is None:
+            return
+        data = json.dumps({'count': self.count, 'lastId': self.last_id, 'keys': sorted(self.keys)},
+                          ensure_ascii=False)
+
+        # write to a temporary file first so that an interrupted run never leaves a broken index
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
+
+        if self.gcs_bucket:
+            self.get_bucket().blob(self.index_path).upload_from_string(
+                data=data.encode('utf-8'), content_type='application/json; charset=utf-8')
+
+    def format_where(self, condition: str = None) -> str:
+        conditions = [c for c in [self.where, condition] if c is not None]
+        return '{AND: [%s]}' % ', '.join(conditions) if len(conditions) > 0 else '{}'
+
+    def refresh(self) -> int:
+        '''refresh pages the items created since the last refresh into the index. It returns the number of the items paged.'''
+        query_template = '''
+        {
+            %s(where: %s, sortBy: id_ASC, first: %d, skip: %d) {
+                id
+                %s
+            }
+        }
+        '''
+        client = self.get_client()
+        paged = 0
+        # the last indexed item is paged again, so a deletion before it is found by the shift of its position
+        skip = max(self.count - 1, 0)
+        check_overlap = self.count > 0
+        while True:
+            items = client.execute(gql(query_template % (
+                self.list_name, self.format_where(), self.page_size, skip, self.key_field)))[self.list_name]
+            page_length = len(items)
+            if check_overlap:
+                check_overlap = False
+                if page_length == 0 or items[0]['id'] != self.last_id:
+                    print(f'[{__name__}] {self.list_name} has deleted items, rebuild the index')
+                    self.reset_index()
+                    skip = 0
+                    continue
+                items = items[1:]
+
+            for item in items:
+                self.keys.add(self.to_key(item[self.key_field]))
+                self.last_id = item['id']
+            self.count += len(items)
+            paged += len(items)
+            skip += page_length
+            if page_length < self.page_size:
+                break
+        self.indexed = True
+        print(f'[{__name__}] {paged} items of {self.list_name} are indexed, {self.count} in total')
+        return paged
+
+    def query_chunk(self, keys: list) -> set:
+        query_template = '''
+        {
+            %s(where: %s) {
+                %s
+            }
+        }
+        '''
+        items = self.get_client().execute(gql(query_template % (
+            self.list_name, self.format_where(self.condition(keys)), self.key_field)))[self.list_name]
+        return {self.to_key(item[self.key_field]) for item in items}
+
+    def find_existing(self, keys: list) -> set:
+        '''find_existing returns the keys which exist in the list'''
+        keys = list(dict.fromkeys(keys))
+        if self.index_path is not None:
+            with self.index_lock:
+                if not self.indexed:
+                    self.refresh()
+                return self.keys.intersection(keys)
+
+        chunks = [keys[i:i + self.chunk_size]
+                  for i in range(0, len(keys), self.chunk_size)]
+        if len(chunks) <= 1:
+            return set().union(*map(self.query_chunk, chunks))
+
+        # the pool is shared by the calls from the threads of the caller, so its workers and their clients are created once
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.parallelism)
+        existing_keys = set()
+        for existing_chunk in self.executor.map(self.query_chunk, chunks):
+            existing_keys.update(existing_chunk)
+        return existing_keys
+
+    def close(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def add(self, keys: list):
+        '''add marks the keys created by the caller as existing, they are paged into the index by the next refresh anyway'''
+        with self.index_lock:
+            self.keys.update(keys)
+
+
+def from_config(create_client, checker_config: dict, **kwargs) -> ExistenceChecker:
+    '''from_config creates the checker with the chunkSize, parallelism and index settings of checker_config'''
+    checker_config = checker_config if checker_config is not None else {}
+    return ExistenceChecker(create_client, chunk_size=checker_config.get('chunkSize', 50),
+                            parallelism=checker_config.get('parallelism', 4), index_path=checker_config.get('indexPath'),
+                            gcs_bucket=checker_config.get('gcsBucket'), **kwargs)
@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+from dateutil import parser
+from lxml import etree
+import re
+
+# the namespaces declared on the rss element by feedgen with the media and dc extensions
+RSS_NSMAP = {
+    'media': 'http://search.yahoo.com/mrss/',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'atom': 'http://www.w3.org/2005/Atom',
+    'content': 'http://purl.org/rss/1.0/modules/content/',
+}
+
+def destination_blob_name(file_config: dict, suffix: str = '') -> str:
+    return file_config['filePathBase'] + \
+        f'/{file_config["filenamePrefix"]}{suffix}.{file_config["extension"]}'
+
+
+def last_updated(posts: list) -> datetime:
+    '''last_updated returns the latest updatedAt of the posts so that the same posts always render the same feed'''
+    return max((parser.isoparse(post['updatedAt']) for post in posts), default=datetime.now(timezone.utc))
+
+
+def rss_item_fragment(entry) -> str:
+    '''rss_item_fragment serializes a feedgen entry to the same <item> as FeedGenerator.rss_str(pretty=True) does'''
+    item = entry.rss_entry()
+    # the item has to be in a rss element so that the namespace prefixes are resolved
+    etree.Element('rss', nsmap=RSS_NSMAP).append(item)
+    etree.indent(item, space='  ', level=2)
+    fragment = etree.tostring(item, encoding='unicode', with_tail=False)
+    # the namespaces are declared on the rss element of the assembled feed
+    return '    ' + re.sub(r'^<item[^>]*>', '<item>', fragment) + '\n'
+
+
+def assemble_rss(fg, fragments: list) -> bytes:
+    '''assemble_rss inserts the item fragments to the channel of the feed'''
+    rss = fg.rss_str(pretty=True, extensions=True,
+                     encoding='UTF-8', xml_declaration=True)
+    return rss.replace(b'  </channel>', ''.join(fragments).encode('utf-8') + b'  </channel>', 1)
@@ -0,0 +1,113 @@
+from dateutil import tz
+from lxml.etree import HTML
+import common.feeds
+import hashlib
+
+tracking_code = """
+<script>
+var _comscore = _comscore || [];
+
+_comscore.push({ c1: "2", c2: "24318560" });
+
+(function() {
+
+var s = document.createElement("script"), el = document.getElementsByTagName("script")[0];
+
+s.async = true; s.src = "https://sb.scorecardresearch.com/cs/24318560/beacon.js";
+
+el.parentNode.insertBefore(s, el);
+
+})();
+</script>
+"""
+
+#  figure class=“op-tracker”
+op_tracker = f"""
+<figure class="op-tracker">
+    <iframe hidden>
+        {tracking_code}
+    </iframe>
+</figure>
+"""
+
+
+def parse_item(base_url: str, item: dict) -> str:
+    name = item['name']
+    publish_time = item['publishTime']  # Should be in ISO format
+    guid = hashlib.sha224((base_url + item['slug']).encode()).hexdigest()
+    brief = item['briefApiData']
+    article_body = parse_html(item)
+    return f"""
+    <item>
+      {op_tracker}
+      <title>{name}</title>
+      <link>http://example.com/article.html</link>
+      <guid>{guid}</guid>
+      <pubDate>{publish_time}</pubDate>
+      <description>{brief}</description>
+      <content:encoded>
+        <![CDATA[
+        <!doctype html>
+        <html lang="en" prefix="op: http://media.facebook.com/op#">
+          <head>
+            <meta charset="utf-8">
+            <link rel="canonical" href="http://example.com/article.html">
+            <meta property="op:markup_version" content="v1.0">
+          </head>
+          <body>
+            <article>
+              <header>
+                <!— Article header goes here -->
+              </header>
+              {article_body}
+              <footer>
+                <!— Article footer goes here -->
+              </footer>
+            </article>
+          </body>
+        </html>
+        ]]>
+      </content:encoded>
+    </item>
+    """
+
+
+def parse_html(item: dict) -> str:
+    if item.get('briefHtml', ''):
+        html = HTML(item['briefHtml'])
+        if html.xpath('//text()'):
+            article_body = html.xpath('//text()')[0]
+        else:
+            article_body = ''
+    else:
+        article_body = ''
+    return article_body
+
+
+def render_feed(config: dict, posts: list) -> bytes:
+    '''render_feed generates the facebook instant articles rss for the posts'''
+    config_feed = config['feed']
+    article_items = '\n'.join([parse_item(config['baseURL'], item) for item in posts])
+    rss_string = f"""
+    <rss version="2.0"
+xmlns:content="http://purl.org/rss/1.0/modules/content/">
+  <channel>
+    <title>{config_feed['title']}</title>
+    <link>{config_feed['link']}</link>
+    <description>
+      {config_feed['description']}
+    </description>
+    <language>zh-tw</language>
+    <lastBuildDate>{common.feeds.last_updated(posts).astimezone(tz.gettz(config_feed['timezone']))}</lastBuildDate>
+    {article_items}
+  </channel>
+</rss>
+    """
+    return rss_string.encode('utf-8')
+
+
+def render(config: dict, posts: list, cache=None) -> dict:
+    '''render returns the facebook instant articles rss keyed by its destination blob name. The entries are not cached.'''
+    return {
+        common.feeds.destination_blob_name(config['file']): render_feed(config, posts[:config.get('maxNumber')])
+    }
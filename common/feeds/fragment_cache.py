@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from common import gcs
+import hashlib
+import json
+import os
+
+
+def hash_config(config: dict) -> str:
+    '''hash_config returns the hash of a renderer config so that a config change invalidates its fragments'''
+    return hashlib.sha1(json.dumps(config, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def fragment_key(renderer: str, config_hash: str, post: dict) -> str:
+    return f'{renderer}:{post["slug"]}:{post["updatedAt"]}:{config_hash}'
+
+
+class FragmentCache:
+    '''
+    FragmentCache keeps the serialized xml of feed entries keyed by (renderer, slug, updatedAt, config hash).
+    The least recently used fragments are evicted once the fragments exceed max_size characters, so a max_size of 0 keeps nothing.
+    The cache is saved to a local file at path, and to gs://gcs_bucket/path when gcs_bucket is set so that a new pod starts warm.
+    Without a path the cache lives in memory only.
+    '''
+
+    def __init__(self, path: str = None, max_size: int = 64 * 1024 * 1024, gcs_bucket: str = None):
+        self.path = path
+        self.max_size = max_size
+        self.gcs_bucket = gcs_bucket
+        self.fragments = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        elif self.gcs_bucket:
+            blob = gcs.get_publisher().client.bucket(
+                self.gcs_bucket).get_blob(self.path)
+            items = json.loads(blob.download_as_bytes().decode(
+                'utf-8')) if blob is not None else []
+        else:
+            items = []
+
+        # items are saved from the least recently used one
+        for key, fragment in items:
+            self.put(key, fragment)
+
+    def save(self):
+        if self.path is None:
+            return
+        data = json.dumps(list(self.fragments.items()), ensure_ascii=False)
+
+        # write to a temporary file first so that an interrupted run never leaves a broken cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+        if self.gcs_bucket:
+            gcs.get_publisher().client.bucket(self.gcs_bucket).blob(self.path).upload_from_string(
+                data=data.encode('utf-8'), content_type='application/json; charset=utf-8')
+        print(f'[{__name__}] saved {len(self.fragments)} fragments({self.size} characters), {self.hits} hits and {self.misses} misses in this run')
+
+    def put(self, key: str, fragment: str):
+        if key in self.fragments:
+            self.size -= len(self.fragments.pop(key))
+        self.fragments[key] = fragment
+        self.size += len(fragment)
+        while self.size > self.max_size and len(self.fragments) > 0:
+            _, evicted = self.fragments.popitem(last=False)
+            self.size -= len(evicted)
+
+    def get_or_render(self, key: str, render, *args) -> str:
+        '''get_or_render returns the cached fragment of the key, or renders it by render(*args) and caches it'''
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            self.hits += 1
+            self.fragments.move_to_end(key)
+            return fragment
+
+        self.misses += 1
+        fragment = render(*args)
+        self.put(key, fragment)
+        return fragment
+
+
+def from_config(cache_config: dict) -> FragmentCache:
+    '''from_config creates the persistent cache of the fragmentCache config, or an in-memory one when it is not configured'''
+    if cache_config is None:
+        return FragmentCache()
+    return FragmentCache(path=cache_config['path'], max_size=cache_config.get('maxSize', 64 * 1024 * 1024),
+                         gcs_bucket=cache_config.get('gcsBucket'))
@@ -0,0 +1,130 @@
+from common.feeds import fragment_cache, sanitizer
+from common.feeds.fragment_cache import fragment_key
+from datetime import datetime, timedelta
+from dateutil import parser
+from lxml.etree import CDATA
+import common.feeds
+import io
+import lxml.etree as ET
+import pytz
+import time
+import uuid
+
+NEWS_AVAILABLE_DAYS = 365
+
+
+# Can not accept structure contains 'array of array'
+def recparse(parentItem, obj):
+    t = type(obj)
+    if t is dict:
+        for name, value in obj.items():
+            subt = type(value)
+            # print(name, value)
+            if subt is dict:
+                thisItem = ET.SubElement(parentItem, name)
+                recparse(thisItem, value)
+            elif subt is list:
+                for item in value:
+                    thisItem = ET.SubElement(parentItem, name)
+                    recparse(thisItem, item)
+            elif subt is not str:
+                thisItem = ET.SubElement(parentItem, name)
+                thisItem.text = str(value)
+            else:
+                thisItem = ET.SubElement(parentItem, name)
+                thisItem.text = stringWrapper(name, value)
+    elif t is list:
+        raise Exception('unsupported structure')
+    return
+
+
+def stringWrapper(name, s):
+    if name in ['title', 'content', 'author']:
+        return CDATA(s)
+    else:
+        return s
+
+
+def tsConverter(s):
+    timeorigin = parser.parse(s)
+    timediff = timeorigin - datetime(1970, 1, 1, tzinfo=pytz.utc)
+    return round(timediff.total_seconds() * 1000)
+
+
+def available_date(article: dict) -> int:
+    return max(tsConverter(article['publishTime']), tsConverter(article['updatedAt']))
+
+
+def render_article(config: dict, article: dict) -> str:
+    '''render_article generates the <article> of a post'''
+    base_url = config['baseURL']
+    availableDate = available_date(article)
+    content = sanitizer.sanitize(article['contentHtml'])
+    title = sanitizer.sanitize(article['name'])
+    item = {
+        'ID': article['id'],
+        'nativeCountry': 'TW',
+        'language': 'zh',
+        'startYmdtUnix': availableDate,
+        'endYmdtUnix': tsConverter(article['publishTime']) + (round(timedelta(NEWS_AVAILABLE_DAYS, 0).total_seconds()) * 1000),
+        'title': title,
+        'category': article['categories'][0]['name'] if len(article['categories']) > 0 else [],
+        'publishTimeUnix': availableDate,
+        'contentType': 0,
+        'contents': {
+            'text': {
+                    'content': content
+            },
+        },
+        'recommendArticles': {
+            'article': [{'title': x['name'], 'url': base_url + '/' + x['slug'] + '/'} for x in article['relatedPosts'][:6] if x]
+        },
+        'author': config['feed']['item']['author']
+    }
+    if article['heroImage'] is not None:
+        item['thumbnail'] = article['heroImage']['urlOriginal']
+
+    element = ET.Element('article')
+    recparse(element, item)
+    return ET.tostring(element, encoding='unicode')
+
+
+def write_feed(config: dict, probes: list, posts, output, cache: fragment_cache.FragmentCache = None) -> int:
+    '''
+    write_feed streams the line today xml of the posts to the binary file-like output, one article at a time, and returns the number of bytes written.
+    posts may be any iterable, e.g. a generator fetching the posts page by page. probes are the slug, publishTime and updatedAt of the same posts,
+    they decide UUID and time which precede the articles. Without a cache, no rendered article is kept.
+    '''
+    cache = cache if cache is not None else fragment_cache.FragmentCache(
+        max_size=0)
+    config_hash = fragment_cache.hash_config(config)
+
+    # UUID and time are derived from the articles so that the same articles always render the same xml
+    root = ET.Element('articles')
+    recparse(root, {
+        'UUID': str(uuid.uuid5(uuid.NAMESPACE_URL, ''.join([fragment_key('lineToday', config_hash, probe) for probe in probes]))),
+        'time': max([available_date(probe) for probe in probes], default=int(round(time.time() * 1000))),
+    })
+    header = ET.tostring(root, encoding='unicode')[:-len('</articles>')]
+
+    written = output.write(
+        ('<?xml version="1.0" encoding="UTF-8" ?>\n    ' + header).encode('utf-8'))
+    for article in posts:
+        written += output.write(cache.get_or_render(fragment_key(
+            'lineToday', config_hash, article), render_article, config, article).encode('utf-8'))
+    written += output.write('</articles>\n    '.encode('utf-8'))
+
+    return written
+
+
+def render_feed(config: dict, posts: list, cache: fragment_cache.FragmentCache = None) -> bytes:
+    '''render_feed generates the line today xml for the posts'''
+    output = io.BytesIO()
+    write_feed(config, posts, posts, output, cache)
+    return output.getvalue()
+
+def render(config: dict, posts: list, cache: fragment_cache.FragmentCache = None) -> dict:
+    '''render returns the line today xml keyed by its destination blob name'''
+    return {
+        common.feeds.destination_blob_name(config['file']): render_feed(config, posts[:config.get('maxNumber')], cache)
+    }
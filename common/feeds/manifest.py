@@ -0,0 +1,40 @@
+from common import gcs
+import json
+import os
+
+'''
+The manifest keeps the posts rendered by the last run keyed by their slugs, so that the next run only fetches the posts which are new or updated.
+It is saved to a local file, or to a GCS object when gcsBucket is configured.
+'''
+
+
+def load(manifest_config: dict) -> dict:
+    '''load returns the posts of the last run keyed by slug'''
+    if manifest_config.get('gcsBucket'):
+        blob = gcs.get_publisher().client.bucket(
+            manifest_config['gcsBucket']).get_blob(manifest_config['path'])
+        if blob is None:
+            return {}
+        return json.loads(blob.download_as_bytes().decode('utf-8'))
+
+    if not os.path.exists(manifest_config['path']):
+        return {}
+    with open(manifest_config['path'], 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save(manifest_config: dict, posts: list):
+    '''save replaces the manifest with the posts of this run'''
+    data = json.dumps({post['slug']: post for post in posts},
+                      ensure_ascii=False)
+
+    if manifest_config.get('gcsBucket'):
+        gcs.get_publisher().client.bucket(manifest_config['gcsBucket']).blob(
+            manifest_config['path']).upload_from_string(data=data.encode('utf-8'), content_type='application/json; charset=utf-8')
+        return
+
+    # write to a temporary file first so that an interrupted run never leaves a broken manifest
+    tmp_path = manifest_config['path'] + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, manifest_config['path'])
@@ -0,0 +1,39 @@
+import re
+import timeit
+
+'''
+sanitizer removes the characters which are not allowed in XML 1.0 from the feed contents.
+'''
+
+# The characters allowed by https://www.w3.org/TR/xml/#charsets
+__valid_xml_chars__ = re.compile(u'[\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]*')
+__invalid_xml_chars__ = re.compile(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+')
+
+
+def sanitize(text: str) -> str:
+    '''sanitize returns text without the invalid XML characters. The same object is returned when there is nothing to remove, which is almost always the case.'''
+    # every invalid character is unprintable, so a title usually passes here without running the regex
+    if text.isprintable():
+        return text
+    # matching the run of valid characters is much faster than searching for an invalid one
+    start = __valid_xml_chars__.match(text).end()
+    if start == len(text):
+        return text
+    # the scan resumes at the first invalid character, so the string is scanned only once
+    return text[:start] + __invalid_xml_chars__.sub('', text[start:])
+
+
+def benchmark(number: int = 200):
+    '''benchmark compares sanitize with the re.sub previously run over each string on contentHtml of realistic sizes'''
+    paragraph = '<p>立法院今（18）日三讀通過修正案，行政院表示將於公布後三個月內施行，相關單位須依規定完成準備。</p>'
+    for size in [2 * 1024, 16 * 1024, 64 * 1024]:
+        clean = paragraph * (size // len(paragraph))
+        dirty = clean[:len(clean) // 2] + '\x08' + clean[len(clean) // 2:]
+        for label, text in [('clean', clean), ('invalid', dirty)]:
+            legacy = timeit.timeit(lambda: re.sub(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+', '', text), number=number)
+            current = timeit.timeit(lambda: sanitize(text), number=number)
+            print(f'[{__name__}] {len(text)} characters({label}): re.sub {legacy / number * 1e6:.1f}us, sanitize {current / number * 1e6:.1f}us')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,96 @@
+from common.feeds import fragment_cache, sanitizer
+from common.feeds.fragment_cache import fragment_key
+from dateutil import parser, tz
+# workaround as feegen raise error: AttributeError: module 'lxml' has no attribute 'etree'
+from lxml import etree
+from feedgen import util
+from feedgen.entry import FeedEntry
+from feedgen.feed import FeedGenerator
+import common.feeds
+import hashlib
+
+
+def render_entry(config: dict, timezone_rss, item: dict) -> str:
+    '''render_entry generates the <item> of a post'''
+    base_url = config['baseURL']
+    config_feed = config['feed']
+
+    guid = hashlib.sha224((base_url+item['slug']).encode()).hexdigest()
+    fe = FeedEntry()
+    fe.load_extension('media', atom=False, rss=True)
+    fe.load_extension('dc', atom=False, rss=True)
+    fe.id(guid)
+    name = sanitizer.sanitize(item['name'])
+    fe.title(name)
+    fe.link(href=base_url+item['slug'], rel='alternate')
+    fe.guid(guid)
+    fe.pubDate(util.formatRFC2822(
+        parser.isoparse(item['publishTime']).astimezone(timezone_rss)))
+    fe.updated(util.formatRFC2822(
+        parser.isoparse(item['updatedAt']).astimezone(timezone_rss)))
+    content = ''
+
+    brief = item['briefHtml']
+    if brief is not None:
+        brief = sanitizer.sanitize(brief)
+        fe.description(description=brief, isSummary=True)
+        content += brief
+    body = ''
+    if item['heroImage'] is not None:
+        fe.media.content(
+            content={'url': item['heroImage']['urlOriginal'], 'medium': 'image'}, group=None)
+        body += '<img src="%s" alt="%s" />' % (
+            item['heroImage']['urlOriginal'], item['heroImage']['name'])
+    if item['contentHtml'] is not None:
+        body += item['contentHtml']
+    if len(item['relatedPosts']) > 0:
+        body += config_feed['item']['relatedPostPrependHtml']
+        for related_post in item['relatedPosts'][:3]:
+            body += '<br/><a href="%s">%s</a>' % (
+                base_url+related_post['slug'], related_post['name'])
+    # brief is sanitized already, so only the rest is scanned
+    content += sanitizer.sanitize(body)
+    fe.content(content=content, type='CDATA')
+    fe.category(
+        list(map(lambda c: {'term': c['name'], 'label': c['name']}, item['categories'])))
+    if item['writers'] is not None:
+        fe.dc.dc_creator(creator=list(
+            map(lambda w: w['name'], item['writers'])))
+
+    return common.feeds.rss_item_fragment(fe)
+
+
+def render_feed(config: dict, posts: list, cache: fragment_cache.FragmentCache = None) -> bytes:
+    '''render_feed generates the yahoo rss for the posts'''
+    config_feed = config['feed']
+    # the timezone for rss
+    timezone_rss = tz.gettz(config_feed['timezone'])
+
+    fg = FeedGenerator()
+    fg.load_extension('media', atom=False, rss=True)
+    fg.load_extension('dc', atom=False, rss=True)
+    fg.title(config_feed['title'])
+    fg.description(config_feed['description'])
+    fg.id(config_feed['id'])
+    fg.pubDate(common.feeds.last_updated(posts).astimezone(timezone_rss))
+    fg.updated(common.feeds.last_updated(posts).astimezone(timezone_rss))
+    fg.image(url=config_feed['image']['url'],
+             title=config_feed['image']['title'], link=config_feed['image']['link'])
+    fg.rights(rights=config_feed['copyright'])
+    fg.link(href=config_feed['link'], rel='alternate')
+    fg.ttl(config_feed['ttl'])  # 5 minutes
+    fg.language('zh-TW')
+
+    cache = cache if cache is not None else fragment_cache.FragmentCache()
+    config_hash = fragment_cache.hash_config(config)
+    fragments = [cache.get_or_render(fragment_key('yahoo', config_hash, item), render_entry, config, timezone_rss, item)
+                 for item in posts]
+
+    return common.feeds.assemble_rss(fg, fragments)
+
+
+def render(config: dict, posts: list, cache: fragment_cache.FragmentCache = None) -> dict:
+    '''render returns the yahoo rss keyed by its destination blob name'''
+    return {
+        common.feeds.destination_blob_name(config['file']): render_feed(config, posts[:config.get('maxNumber')], cache)
+    }
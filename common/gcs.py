@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import storage
+import base64
+import gzip
+import hashlib
+import io
+import time
+
+
+class Publisher:
+    '''Publisher uploads gzipped objects to GCS with one authenticated client shared by all the uploads'''
+
+    def __init__(self, max_workers: int = 8, content_language: str = 'zh', cache_control: str = 'max-age=300,public'):
+        # storage.Client keeps an authorized session, so the token and the connections are reused by every upload
+        self.client = storage.Client()
+        self.max_workers = max_workers
+        self.content_language = content_language
+        self.cache_control = cache_control
+
+    def upload(self, bucket_name: str, destination_blob_name: str, data: bytes, content_type: str) -> dict:
+        '''upload gzips the data and uploads it with its metadata in the same request. It returns the stats of the upload.'''
+        # mtime is fixed so that the same data is always compressed to the same bytes
+        compressed_data = gzip.compress(data=data, compresslevel=9, mtime=0)
+        return self.upload_gzipped_file(bucket_name, destination_blob_name, io.BytesIO(compressed_data), content_type, len(data))
+
+    def upload_gzipped_file(self, bucket_name: str, destination_blob_name: str, file_obj, content_type: str, raw_bytes: int = None) -> dict:
+        '''upload_gzipped_file uploads the gzipped content of file_obj unless the existing object has the same MD5. It returns the stats of the upload.'''
+        start = time.perf_counter()
+        bucket = self.client.bucket(bucket_name)
+
+        # read the file in chunks so that a large file is never loaded in memory
+        file_obj.seek(0)
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: file_obj.read(1024 * 1024), b''):
+            md5.update(chunk)
+        compressed_bytes = file_obj.tell()
+        file_obj.seek(0)
+
+        stats = {
+            'object': f'gs://{bucket_name}/{destination_blob_name}',
+            'bytes': raw_bytes,
+            'compressedBytes': compressed_bytes,
+            'skipped': False,
+        }
+
+        existing_blob = bucket.get_blob(destination_blob_name)
+        if existing_blob is not None and existing_blob.md5_hash == base64.b64encode(md5.digest()).decode('utf-8'):
+            stats['skipped'] = True
+        else:
+            blob = bucket.blob(destination_blob_name)
+            # the metadata is sent along with the data instead of a follow-up patch
+            blob.content_encoding = 'gzip'
+            blob.content_language = self.content_language
+            blob.cache_control = self.cache_control
+            blob.upload_from_file(file_obj, size=compressed_bytes,
+                                  content_type=content_type, client=self.client)
+
+        stats['latencyMs'] = round((time.perf_counter() - start) * 1000)
+        print(
+            f'[{__name__}] {stats["object"]} {"is unchanged" if stats["skipped"] else "is uploaded"}: {stats["bytes"]} bytes, {stats["compressedBytes"]} bytes gzipped, {stats["latencyMs"]}ms')
+        return stats
+
+    def upload_many(self, uploads: list) -> list:
+        '''upload_many uploads the objects concurrently. Each upload is a dict of the arguments of upload.'''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.upload, **upload)
+                       for upload in uploads]
+            return [future.result() for future in futures]
+
+
+__publisher = None
+
+
+def get_publisher() -> Publisher:
+    '''get_publisher returns the publisher shared in the process'''
+    global __publisher
+    if __publisher is None:
+        __publisher = Publisher()
+    return __publisher
@@ -0,0 +1,35 @@
+import json
+import os
+
+
+def get_bucket(bucket_name: str):
+    # google-cloud-storage is only required when the state is kept in GCS
+    from common import gcs
+    return gcs.get_publisher().client.bucket(bucket_name)
+
+
+def load(state_config: dict, default: dict) -> dict:
+    '''load loads the state kept across the runs of a job from state_config.path, or gs://gcsBucket/path when gcsBucket is set'''
+    if state_config.get('gcsBucket'):
+        blob = get_bucket(state_config['gcsBucket']).get_blob(
+            state_config['path'])
+        return json.loads(blob.download_as_bytes().decode('utf-8')) if blob is not None else default
+
+    if not os.path.exists(state_config['path']):
+        return default
+    with open(state_config['path'], 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save(state_config: dict, state: dict):
+    data = json.dumps(state, ensure_ascii=False)
+    if state_config.get('gcsBucket'):
+        get_bucket(state_config['gcsBucket']).blob(
+            state_config['path']).upload_from_string(data=data.encode('utf-8'), content_type='application/json; charset=utf-8')
+        return
+
+    # write to a temporary file first so that an interrupted run never leaves a broken state
+    tmp_path = state_config['path'] + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, state_config['path'])
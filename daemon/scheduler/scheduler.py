@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from gql import gql, Client
+from gql.transport.aiohttp import AIOHTTPTransport
+import __main__
+import argparse
+import asyncio
+import heapq
+import importlib.util
+import inspect
+import os
+import signal
+import sys
+import threading
+import time
+import yaml
+
+'''
+scheduler runs all the cronjobs in one resident process. The job scripts are imported once at start, so every run reuses the warm imports,
+the shared GCS publisher and the cached CMS logins instead of starting a new interpreter.
+'''
+
+CONFIG_KEY = 'config'
+
+ROOT_FOLDER = os.path.abspath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+__cron_field_ranges__ = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+
+def parse_cron(expression: str) -> tuple:
+    '''
+    parse_cron converts the five fields of a cron expression, e.g. "*/5 * * * *", to the sets of the allowed values,
+    and tells whether a day matches either day field, as cron does when both the day of month and the day of week are restricted
+    '''
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError(f'cron expression({expression}) must have 5 fields')
+
+    allowed = []
+    for field, (low, high) in zip(fields, __cron_field_ranges__):
+        values = set()
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = [int(v) for v in value_range.split('-')]
+            else:
+                start = int(value_range)
+                end = high if step else start
+            values.update(range(start, end + 1, int(step) if step else 1))
+        allowed.append(values)
+    return allowed, not fields[2].startswith('*') and not fields[4].startswith('*')
+
+
+def next_cron_time(parsed: tuple, after: datetime) -> datetime:
+    '''next_cron_time returns the first minute later than after which matches the cron expression parsed by parse_cron'''
+    (minutes, hours, days, months, weekdays), either_day = parsed
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    # a year is enough for any valid expression
+    for _ in range(366 * 24 * 60):
+        # cron counts the weekday from sunday
+        day_matches = (t.day in days, (t.weekday() + 1) % 7 in weekdays)
+        if t.month in months and (any(day_matches) if either_day else all(day_matches)) and t.hour in hours and t.minute in minutes:
+            return t
+        t += timedelta(minutes=1)
+    raise ValueError(f'cron fields({parsed}) never match')
+
+
+def load_module(name: str, script: str):
+    '''load_module imports the job script once. Its folder is added to sys.path for the modules next to it, e.g. util of esFeed.'''
+    script_path = os.path.join(ROOT_FOLDER, script)
+    script_folder = os.path.dirname(script_path)
+    if script_folder not in sys.path:
+        sys.path.append(script_folder)
+    spec = importlib.util.spec_from_file_location(name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_yaml(path: str) -> dict:
+    with open(os.path.join(ROOT_FOLDER, path), 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+def authenticate(config_graphql: dict) -> str:
+    gql_client = Client(
+        transport=AIOHTTPTransport(url=config_graphql['apiEndpoint']),
+        fetch_schema_from_transport=False,
+    )
+    qgl_mutation_authenticate_get_token = '''
+    mutation {
+        authenticate: authenticateUserWithPassword(email: "%s", password: "%s") {
+            token
+        }
+    }
+    '''
+    mutation = qgl_mutation_authenticate_get_token % (
+        config_graphql['username'], config_graphql['password'])
+
+    return gql_client.execute(gql(mutation))['authenticate']['token']
+
+
+def create_gql_client(gql_endpoint: str, token: str) -> Client:
+    gql_transport_with_token = AIOHTTPTransport(
+        url=gql_endpoint,
+        headers={
+            'Authorization': f'Bearer {token}'
+        },
+        timeout=60
+    )
+
+    return Client(
+        transport=gql_transport_with_token,
+        execute_timeout=60,
+        fetch_schema_from_transport=False,
+    )
+
+
+class Scheduler:
+    '''
+    Scheduler runs the jobs of the schedule config in a thread pool.
+    A job is skipped when its previous run is still running, and a run longer than its timeout is reported.
+    Python threads cannot be killed, so the process exits on a timeout when exitOnTimeout is set and lets the cluster restart it.
+    '''
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.jobs = {job['name']: job for job in config['jobs']}
+        self.modules = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get('maxWorkers', 4))
+        self.running = {}
+        self.timed_out = set()
+        self.tokens = {}
+        self.tokens_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def load(self):
+        for name, job in self.jobs.items():
+            start = time.perf_counter()
+            self.modules[name] = load_module(name, job['script'])
+            print(f'[{__main__.__file__}] job({name}) is loaded in {round((time.perf_counter() - start) * 1000)}ms')
+
+    def get_token(self, name: str, config_graphql: dict) -> str:
+        '''get_token returns the CMS token shared by the jobs, and logs in again when it has expired'''
+        key = (config_graphql['apiEndpoint'], config_graphql['username'])
+        with self.tokens_lock:
+            token, created_at = self.tokens.get(key, (None, 0))
+            if token is None or time.time() - created_at > self.config.get('authTTL', 3600):
+                token = authenticate(config_graphql)
+                self.tokens[key] = (token, time.time())
+                print(f'[{__main__.__file__}] job({name}) logged in to {key[0]} as {key[1]}')
+            return token
+
+    def invalidate_token(self, config_graphql: dict):
+        with self.tokens_lock:
+            self.tokens.pop(
+                (config_graphql['apiEndpoint'], config_graphql['username']), None)
+
+    def run_job(self, name: str):
+        '''run_job calls main of the job with the arguments of the schedule config, which are read again for every run'''
+        job = self.jobs[name]
+        main = self.modules[name].main
+        kwargs = dict(job.get('kwargs', {}))
+        for arg, path in job.get('yamlKwargs', {}).items():
+            kwargs[arg] = load_yaml(path)
+
+        # gql executes the queries in the event loop of the current thread
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        start = time.perf_counter()
+        config_graphql = kwargs.get(job.get('graphqlKwarg', 'config_graphql'))
+        try:
+            # the token is shared, but every run gets its own client in its own event loop, a connected gql client cannot be used by two threads.
+            # The jobs running several workers take the token instead, and make a client for every worker.
+            parameters = inspect.signature(main).parameters
+            if 'gql_client' in parameters and config_graphql is not None:
+                kwargs['gql_client'] = create_gql_client(
+                    config_graphql['apiEndpoint'], self.get_token(name, config_graphql))
+            elif 'token' in parameters and config_graphql is not None:
+                kwargs['token'] = self.get_token(name, config_graphql)
+            main(**kwargs)
+            print(f'[{__main__.__file__}] job({name}) is finished in {round((time.perf_counter() - start) * 1000)}ms')
+        except BaseException as e:
+            # the login is done again in case the token is the cause
+            if config_graphql is not None:
+                self.invalidate_token(config_graphql)
+            print(f'[{__main__.__file__}] job({name}) failed in {round((time.perf_counter() - start) * 1000)}ms: {repr(e)}')
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    def submit(self, name: str):
+        future, _ = self.running.get(name, (None, None))
+        if future is not None and not future.done():
+            print(f'[{__main__.__file__}] job({name}) is still running. Skip this run.')
+            return
+        self.timed_out.discard(name)
+        self.running[name] = (self.executor.submit(
+            self.run_job, name), time.time())
+
+    def check_timeouts(self):
+        for name, (future, started_at) in self.running.items():
+            timeout = self.jobs[name].get('timeout')
+            if timeout is None or future.done() or name in self.timed_out:
+                continue
+            if time.time() - started_at > timeout:
+                self.timed_out.add(name)
+                print(f'[{__main__.__file__}] job({name}) has been running for more than {timeout} seconds')
+                if self.config.get('exitOnTimeout', False):
+                    with open('/dev/termination-log', 'w') as f:
+                        f.write(f'job({name}) timed out')
+                    os._exit(1)
+
+    def next_time(self, name: str, after: datetime) -> datetime:
+        job = self.jobs[name]
+        if 'intervalSeconds' in job:
+            return after + timedelta(seconds=job['intervalSeconds'])
+        return next_cron_time(parse_cron(job['schedule']), after)
+
+    def run_forever(self):
+        now = datetime.now(timezone.utc)
+        heap = [(self.next_time(name, now), name) for name in self.jobs]
+        heapq.heapify(heap)
+
+        while not self.stopped.is_set():
+            due, name = heap[0]
+            # wake up at the due time of the next job, or every second to check the timeouts
+            delay = (due - datetime.now(timezone.utc)).total_seconds()
+            if delay > 0:
+                self.stopped.wait(min(delay, 1))
+                self.check_timeouts()
+                continue
+
+            heapq.heapreplace(heap, (self.next_time(name, due), name))
+            self.submit(name)
+
+        print(f'[{__main__.__file__}] waiting for the running jobs...')
+        self.executor.shutdown(wait=True)
+
+
+def main(config: dict):
+    print(f'[{__main__.__file__}] executing...')
+
+    scheduler = Scheduler(config)
+    scheduler.load()
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: scheduler.stopped.set())
+    scheduler.run_forever()
+
+    print(f'[{__main__.__file__}] exiting... goodbye...')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Process configuration of scheduler')
+    parser.add_argument('-c', '--config', dest=CONFIG_KEY,
+                        help='schedule config file of all the jobs', metavar='FILE', type=str, required=True)
+    args = parser.parse_args()
+
+    with open(getattr(args, CONFIG_KEY), 'r') as stream:
+        config = yaml.safe_load(stream)
+
+    main(config)
@@ -5,6 +5,9 @@ set -x
 EXECFOLDER=$1
 EXECSCRIPT=$2
 ENVFOLDER=.venv
+# modules shared by the jobs, e.g. common.feeds, are imported from the repository root
+ROOTFOLDER=$(cd "$(dirname "$0")" && pwd)
+export PYTHONPATH=$ROOTFOLDER${PYTHONPATH:+:$PYTHONPATH}
 
 if cd $EXECFOLDER \
     && . ./$ENVFOLDER/bin/activate \
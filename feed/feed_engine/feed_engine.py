@@ -0,0 +1,249 @@
+from common import gcs
+from common.feeds import facebook_ia, fragment_cache, google_news, line_today, manifest, yahoo
+from gql import gql, Client
+from gql.transport.aiohttp import AIOHTTPTransport
+import __main__
+import argparse
+import json
+import logging
+import yaml
+
+'''
+feed_engine fetches the posts once and runs every configured renderer, e.g. yahoo, googleNews, lineToday and facebookIA, over the same result.
+'''
+
+CONFIG_KEY = 'config'
+GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
+NUMBER_KEY = 'number'
+
+# renderers keyed by their name in the config, each of them accepts (renderer_config, posts, fragment_cache)
+# and returns the rendered files keyed by their destination blob name.
+# The registry lives here rather than in common.feeds, so a job importing one renderer does not need the dependencies of the others, e.g. feedgen.
+RENDERERS = {
+    'yahoo': yahoo.render,
+    'googleNews': google_news.render,
+    'lineToday': line_today.render,
+    'facebookIA': facebook_ia.render,
+}
+
+# The union of the fields required by all the renderers
+__post_fields__ = '''
+        id
+        name
+        slug
+        briefHtml
+        briefApiData
+        contentHtml
+        heroImage {
+            urlOriginal
+            name
+        }
+        categories {
+            name
+            slug
+        }
+        relatedPosts {
+            name
+            slug
+        }
+        writers {
+            name
+        }
+        publishTime
+        updatedAt
+'''
+
+__qgl_post_template__ = '''
+{
+    allPosts(where: %s, sortBy: publishTime_DESC, first: %d) {
+        %s
+    }
+}
+'''
+
+# The cheap query to find out which posts are new or updated since the last run
+__qgl_probe_template__ = '''
+{
+    allPosts(where: %s, sortBy: publishTime_DESC, first: %d) {
+        slug
+        updatedAt
+    }
+}
+'''
+
+__qgl_posts_by_slugs_template__ = '''
+{
+    allPosts(where: {slug_in: %s}) {
+        %s
+    }
+}
+'''
+
+# The follow-up query of the posts missing from the google news categories, one alias per category
+__qgl_category_posts_template__ = '''
+    %s: allPosts(where: {AND: [%s, {categories_some: {slug: %s}}, {slug_not_in: %s}]}, sortBy: publishTime_DESC, first: %d) {
+        %s
+    }
+'''
+
+
+def create_authenticated_k5_client(config_graphql: dict) -> Client:
+    logger = logging.getLogger(__main__.__file__)
+    logger.setLevel('INFO')
+    # Authenticate through GraphQL
+
+    gql_endpoint = config_graphql['apiEndpoint']
+    gql_transport = AIOHTTPTransport(
+        url=gql_endpoint,
+    )
+    gql_client = Client(
+        transport=gql_transport,
+        fetch_schema_from_transport=False,
+    )
+    qgl_mutation_authenticate_get_token = '''
+    mutation {
+        authenticate: authenticateUserWithPassword(email: "%s", password: "%s") {
+            token
+        }
+    }
+    '''
+    mutation = qgl_mutation_authenticate_get_token % (
+        config_graphql['username'], config_graphql['password'])
+
+    token = gql_client.execute(gql(mutation))['authenticate']['token']
+
+    gql_transport_with_token = AIOHTTPTransport(
+        url=gql_endpoint,
+        headers={
+            'Authorization': f'Bearer {token}'
+        },
+        timeout=60
+    )
+
+    return Client(
+        transport=gql_transport_with_token,
+        execute_timeout=60,
+        fetch_schema_from_transport=False,
+    )
+
+
+def fetch_posts(gql_client: Client, post_where_filter: str, number: int) -> list:
+    '''fetch_posts retrieves the latest posts with the fields of all renderers in one query'''
+    query = gql(__qgl_post_template__ %
+                (post_where_filter, number, __post_fields__))
+    return gql_client.execute(query)['allPosts']
+
+
+def fetch_changed_posts(gql_client: Client, post_where_filter: str, number: int, manifest_config: dict) -> list:
+    '''fetch_changed_posts probes slug and updatedAt of the latest posts and only retrieves the heavy fields of the posts which are not in the manifest or have been updated'''
+    probes = gql_client.execute(
+        gql(__qgl_probe_template__ % (post_where_filter, number)))['allPosts']
+    cached_posts = manifest.load(manifest_config)
+
+    changed_slugs = [probe['slug'] for probe in probes if probe['slug'] not in cached_posts
+                     or cached_posts[probe['slug']]['updatedAt'] != probe['updatedAt']]
+    print(f'[{__main__.__file__}] {len(changed_slugs)} of {len(probes)} posts are new or updated')
+
+    fetched_posts = {}
+    if len(changed_slugs) > 0:
+        query = gql(__qgl_posts_by_slugs_template__ %
+                    (json.dumps(changed_slugs, ensure_ascii=False), __post_fields__))
+        fetched_posts = {post['slug']: post for post in gql_client.execute(query)[
+            'allPosts']}
+
+    posts = []
+    for probe in probes:
+        if probe['slug'] in fetched_posts:
+            posts.append(fetched_posts[probe['slug']])
+        elif probe['slug'] not in changed_slugs:
+            posts.append(cached_posts[probe['slug']])
+
+    manifest.save(manifest_config, posts)
+    return posts
+
+
+def fetch_missing_category_posts(gql_client: Client, post_where_filter: str, renderer_config: dict, posts: list) -> list:
+    '''
+    fetch_missing_category_posts returns the posts of the google news categories which have fewer than maxNumber posts in the shared posts.
+    The posts missing from all such categories are retrieved by one query, so a small category has as many items as its own query used to give.
+    '''
+    max_number = renderer_config.get('maxNumber', 25)
+    subqueries = []
+    for index, category in enumerate(renderer_config['categories'].values()):
+        category_slugs = [post['slug'] for post in posts if any(
+            c['slug'] == category['slug'] for c in post['categories'])]
+        if len(category_slugs) < max_number:
+            subqueries.append(__qgl_category_posts_template__ % (f'category{index}', post_where_filter, json.dumps(category['slug'], ensure_ascii=False),
+                                                                 json.dumps(category_slugs, ensure_ascii=False), max_number - len(category_slugs), __post_fields__))
+    if len(subqueries) == 0:
+        return []
+
+    result = gql_client.execute(gql('{%s}' % ''.join(subqueries)))
+    missing_posts = list({post['slug']: post for category_posts in result.values()
+                          for post in category_posts}.values())
+    print(f'[{__main__.__file__}] retrieved {len(missing_posts)} posts missing from {len(subqueries)} google news categories')
+    return missing_posts
+
+
+def main(config: dict, config_graphql: dict, number: int, gql_client: Client = None):
+    '''
+    main fetches the latest number posts once and renders every configured renderer from them.
+    The renderers share the postWhereFilter of the engine, they have no filter of their own.
+    The google news categories are split from the shared posts, and the categories short of maxNumber posts are completed by one follow-up query.
+    '''
+    print(f'[{__main__.__file__}] executing...')
+
+    if gql_client is None:
+        gql_client = create_authenticated_k5_client(config_graphql)
+    if config.get('manifest') is not None:
+        posts = fetch_changed_posts(
+            gql_client, config['postWhereFilter'], number, config['manifest'])
+    else:
+        posts = fetch_posts(gql_client, config['postWhereFilter'], number)
+    print(f'[{__main__.__file__}] retrieved {len(posts)} posts')
+
+    cache = fragment_cache.from_config(config.get('fragmentCache'))
+    uploads = []
+    for renderer_name, renderer_config in config['renderers'].items():
+        if renderer_name not in RENDERERS:
+            print(f'[{__main__.__file__}] renderer({renderer_name}) is not supported. Skip it.')
+            continue
+        print(f'[{__main__.__file__}] rendering {renderer_name}')
+        renderer_posts = posts
+        if renderer_name == 'googleNews':
+            # the missing posts are older than the shared ones, so they follow them in the publishTime order
+            renderer_posts = posts + fetch_missing_category_posts(
+                gql_client, config['postWhereFilter'], renderer_config, posts)
+        rendered = RENDERERS[renderer_name](renderer_config, renderer_posts, cache)
+        uploads.extend([{
+            'bucket_name': renderer_config['file']['gcsBucket'],
+            'data': data,
+            'content_type': 'application/xml; charset=utf-8',
+            'destination_blob_name': destination_blob_name,
+        } for destination_blob_name, data in rendered.items()])
+
+    cache.save()
+
+    gcs.get_publisher().upload_many(uploads)
+
+    print(f'[{__main__.__file__}] exiting... goodbye...')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Process configuration of feed_engine')
+    parser.add_argument('-c', '--config', dest=CONFIG_KEY,
+                        help='config file for feed_engine', metavar='FILE', type=str, required=True)
+    parser.add_argument('-g', '--config-graphql', dest=GRAPHQL_CMS_CONFIG_KEY,
+                        help='graphql config file for feed_engine', metavar='FILE', type=str, required=True)
+    parser.add_argument('-m', '--max-number', dest=NUMBER_KEY,
+                        help='number of posts fetched for all the renderers', metavar='150', type=int, required=True)
+    args = parser.parse_args()
+
+    with open(getattr(args, CONFIG_KEY), 'r') as stream:
+        config = yaml.safe_load(stream)
+    with open(getattr(args, GRAPHQL_CMS_CONFIG_KEY), 'r') as stream:
+        config_graphql = yaml.safe_load(stream)
+    number = getattr(args, NUMBER_KEY)
+
+    main(config, config_graphql, number)
@@ -1,46 +1,24 @@
-from datetime import datetime, timedelta
-from dateutil import parser
-from google.cloud import storage
+from common import gcs
+from common.feeds import fragment_cache, line_today
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
-from lxml.etree import CDATA, tostring
 import __main__
 import argparse
+import datetime
 import gzip
 import json
 import logging
-import lxml.etree as ET
-import pytz
 import sys
-import time
+import tempfile
 import unicodedata
 import urllib.request
-import uuid
 import yaml
-import re
-
-print(f'[{__main__.__file__}] executing...')
 
 CONFIG_KEY = 'config'
 GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
 NUMBER_KEY = 'number'
-
-yaml_parser = argparse.ArgumentParser(
-    description='Process configuration of generate_google_news_rss')
-yaml_parser.add_argument('-c', '--config', dest=CONFIG_KEY,
-                         help='config file for generate_google_news_rss', metavar='FILE', type=str)
-yaml_parser.add_argument('-g', '--config-graphql', dest=GRAPHQL_CMS_CONFIG_KEY,
-                         help='graphql config file for generate_google_news_rss', metavar='FILE', type=str, required=True)
-yaml_parser.add_argument('-m', '--max-number', dest=NUMBER_KEY,
-                         help='number of feed items', metavar='75', type=int, required=True)
-args = yaml_parser.parse_args()
-
-with open(getattr(args, CONFIG_KEY), 'r') as stream:
-    config = yaml.safe_load(stream)
-with open(getattr(args, GRAPHQL_CMS_CONFIG_KEY), 'r') as stream:
-    config_graphql = yaml.safe_load(stream)
-number = getattr(args, NUMBER_KEY)
-
+STREAM_KEY = 'stream'
+PAGE_SIZE_KEY = 'pageSize'
 
 def create_authenticated_k5_client(config_graphql: dict) -> Client:
     logger = logging.getLogger(__main__.__file__)
@@ -82,12 +60,7 @@ def create_authenticated_k5_client(config_graphql: dict) -> Client:
     )
 
 
-__gql_client__ = create_authenticated_k5_client(config_graphql)
-
-# To retrieve the latest 100 published posts
-__qgl_post_template__ = '''
-{
-    allPosts(where: %s, sortBy: publishTime_DESC, first: %d) {
+__post_fields__ = '''
         id
         name
         slug
@@ -109,121 +82,103 @@ __qgl_post_template__ = '''
         }
         publishTime
         updatedAt
+'''
+
+# To retrieve the latest 100 published posts
+__qgl_post_template__ = '''
+{
+    allPosts(where: %s, sortBy: publishTime_DESC, first: %d) {
+        %s
     }
 }
 '''
 
-__gql_query__ = gql(__qgl_post_template__ %
-                    (config['postWhereFilter'], number))
-__result__ = __gql_client__.execute(__gql_query__)
-
-# Can not accept structure contains 'array of array'
-
-
-def recparse(parentItem, obj):
-    t = type(obj)
-    if t is dict:
-        for name, value in obj.items():
-            subt = type(value)
-            # print(name, value)
-            if subt is dict:
-                thisItem = ET.SubElement(parentItem, name)
-                recparse(thisItem, value)
-            elif subt is list:
-                for item in value:
-                    thisItem = ET.SubElement(parentItem, name)
-                    recparse(thisItem, item)
-            elif subt is not str:
-                thisItem = ET.SubElement(parentItem, name)
-                thisItem.text = str(value)
-            else:
-                thisItem = ET.SubElement(parentItem, name)
-                thisItem.text = stringWrapper(name, value)
-    elif t is list:
-        raise Exception('unsupported structure')
-    return
-
-
-def stringWrapper(name, s):
-    if name in ['title', 'content', 'author']:
-        return CDATA(s)
-    else:
-        return s
-
-
-def tsConverter(s):
-    timeorigin = parser.parse(s)
-    timediff = timeorigin - datetime(1970, 1, 1, tzinfo=pytz.utc)
-    return round(timediff.total_seconds() * 1000)
-
-
-def upload_data(bucket_name: str, data: bytes, content_type: str, destination_blob_name: str):
-    '''Uploads a file to the bucket.'''
-    # bucket_name = 'your-bucket-name'
-    # data = 'storage-object-content'
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.content_encoding = 'gzip'
-    print(f'[{__main__.__file__}] uploadling data to gs://{bucket_name}{destination_blob_name}')
-    blob.upload_from_string(
-        data=gzip.compress(data=data, compresslevel=9), content_type=content_type, client=storage_client)
-    blob.content_language = 'zh'
-    blob.cache_control = 'max-age=300,public'
-    blob.patch()
-
-    print(
-        f'[{__main__.__file__}] finished uploading gs://{bucket_name}{destination_blob_name}')
-
+# The cheap query of the posts in the available window for the stream mode
+__qgl_probe_template__ = '''
+{
+    allPosts(where: {AND: [%s, {publishTime_gte: "%s"}]}, sortBy: publishTime_DESC, first: %d) {
+        slug
+        publishTime
+        updatedAt
+    }
+}
+'''
 
-if __name__ == '__main__':
-    mainXML = {
-        'UUID': str(uuid.uuid4()),
-        'time': int(round(time.time() * 1000)),
-        'article': []
+__qgl_posts_by_slugs_template__ = '''
+{
+    allPosts(where: {slug_in: %s}) {
+        %s
     }
+}
+'''
 
-    articles = __result__['allPosts']
-
-    news_available_days = 365
-    base_url = config['baseURL']
-    for article in articles:
-        availableDate = max(tsConverter(
-            article['publishTime']), tsConverter(article['updatedAt']))
-        content = re.sub(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+', '', article['contentHtml'])
-        title = re.sub(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+', '', article['name'])
-        item = {
-            'ID': article['id'],
-            'nativeCountry': 'TW',
-            'language': 'zh',
-            'startYmdtUnix': availableDate,
-            'endYmdtUnix': tsConverter(article['publishTime']) + (round(timedelta(news_available_days, 0).total_seconds()) * 1000),
-            'title': title,
-            'category': article['categories'][0]['name'] if len(article['categories']) > 0 else [],
-            'publishTimeUnix': availableDate,
-            'contentType': 0,
-            'contents': {
-                'text': {
-                        'content': content
-                },
-            },
-            'recommendArticles': {
-                'article': [{'title': x['name'], 'url': base_url + '/' + x['slug'] + '/'} for x in article['relatedPosts'][:6] if x]
-            },
-            'author': config['feed']['item']['author']
-        }
-        if article['heroImage'] is not None:
-            item['thumbnail'] = article['heroImage']['urlOriginal']
 
-        mainXML['article'].append(item)
+def fetch_pages(gql_client: Client, probes: list, page_size: int):
+    '''fetch_pages yields the posts of the probes in their order, fetching the heavy fields of page_size posts at a time'''
+    for i in range(0, len(probes), page_size):
+        slugs = [probe['slug'] for probe in probes[i:i + page_size]]
+        query = gql(__qgl_posts_by_slugs_template__ %
+                    (json.dumps(slugs, ensure_ascii=False), __post_fields__))
+        posts = {post['slug']: post for post in gql_client.execute(query)[
+            'allPosts']}
+        for slug in slugs:
+            if slug in posts:
+                yield posts[slug]
 
-    root = ET.Element('articles')
-    recparse(root, mainXML)
 
-    data = '''<?xml version="1.0" encoding="UTF-8" ?>
-    %s
-    ''' % ET.tostring(root, encoding="unicode")
+def stream_feed(gql_client: Client, config: dict, number: int, page_size: int, cache: fragment_cache.FragmentCache) -> dict:
+    '''stream_feed writes the xml to a gzipped temporary file page by page and uploads it, so that only one page of posts is in memory at a time'''
+    since = datetime.datetime.now(datetime.timezone.utc) - \
+        datetime.timedelta(days=line_today.NEWS_AVAILABLE_DAYS)
+    probes = gql_client.execute(gql(__qgl_probe_template__ % (
+        config['postWhereFilter'], since.isoformat(), number)))['allPosts']
+    print(f'[{__main__.__file__}] {len(probes)} posts are in the available window')
+
+    file_config = config['file']
+    with tempfile.TemporaryFile() as tmp_file:
+        # mtime is fixed so that the same xml is always compressed to the same bytes
+        with gzip.GzipFile(fileobj=tmp_file, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+            written = line_today.write_feed(config, probes, fetch_pages(
+                gql_client, probes, page_size), gzip_file, cache)
+        print(f'[{__main__.__file__}] generated xml of {written} bytes')
+
+        return gcs.get_publisher().upload_gzipped_file(
+            bucket_name=file_config['gcsBucket'],
+            destination_blob_name=file_config['filePathBase'] +
+            f'/{file_config["filenamePrefix"]}.{file_config["extension"]}',
+            file_obj=tmp_file,
+            content_type='application/xml; charset=utf-8',
+            raw_bytes=written,
+        )
+
+
+def main(config: dict, config_graphql: dict, number: int, stream: bool = False, page_size: int = 50, gql_client: Client = None) -> dict:
+    '''
+    main generates the line today xml of the latest number posts and uploads it. It returns the stats of the upload.
+    With stream, the xml is written to a gzipped temporary file page by page instead of in memory.
+    A long-lived caller may pass its authenticated gql_client to skip the login.
+    '''
+    print(f'[{__main__.__file__}] executing...')
+
+    if gql_client is None:
+        gql_client = create_authenticated_k5_client(config_graphql)
+
+    if stream:
+        # an in-memory cache would keep every article of the window, so without a fragmentCache config the fragments are not kept at all
+        cache = fragment_cache.from_config(config['fragmentCache']) if config.get(
+            'fragmentCache') is not None else fragment_cache.FragmentCache(max_size=0)
+        stats = stream_feed(gql_client, config, number, page_size, cache)
+        cache.save()
+        print(f'[{__main__.__file__}] exiting... goodbye...')
+        return stats
+
+    cache = fragment_cache.from_config(config.get('fragmentCache'))
+    gql_query = gql(__qgl_post_template__ %
+                    (config['postWhereFilter'], number, __post_fields__))
+    result = gql_client.execute(gql_query)
+
+    data = line_today.render_feed(config, result['allPosts'], cache)
+    cache.save()
 
     file_config = config['file']
     # The name for the new bucket
@@ -232,14 +187,39 @@ if __name__ == '__main__':
     # rss folder path
     rss_base = file_config['filePathBase']
 
-    print(f'[{__main__.__file__}] generated xml: {data}')
+    print(f'[{__main__.__file__}] generated xml: {data.decode("utf-8")}')
 
-    upload_data(
+    stats = gcs.get_publisher().upload(
         bucket_name=bucket_name,
-        data=data.encode('utf-8'),
+        data=data,
         content_type='application/xml; charset=utf-8',
         destination_blob_name=rss_base +
         f'/{file_config["filenamePrefix"]}.{file_config["extension"]}'
     )
 
-print(f'[{__main__.__file__}] exiting... goodbye...')
+    print(f'[{__main__.__file__}] exiting... goodbye...')
+    return stats
+
+
+if __name__ == '__main__':
+    yaml_parser = argparse.ArgumentParser(
+        description='Process configuration of generate_line_today_xml')
+    yaml_parser.add_argument('-c', '--config', dest=CONFIG_KEY,
+                             help='config file for generate_line_today_xml', metavar='FILE', type=str)
+    yaml_parser.add_argument('-g', '--config-graphql', dest=GRAPHQL_CMS_CONFIG_KEY,
+                             help='graphql config file for generate_line_today_xml', metavar='FILE', type=str, required=True)
+    yaml_parser.add_argument('-m', '--max-number', dest=NUMBER_KEY,
+                             help='number of feed items', metavar='75', type=int, required=True)
+    yaml_parser.add_argument('-s', '--stream', dest=STREAM_KEY, action='store_true',
+                             help='stream the articles to a gzipped temporary file page by page instead of rendering the whole xml in memory')
+    yaml_parser.add_argument('-p', '--page-size', dest=PAGE_SIZE_KEY,
+                             help='number of posts fetched per page in the stream mode', metavar='50', type=int, default=50)
+    args = yaml_parser.parse_args()
+
+    with open(getattr(args, CONFIG_KEY), 'r') as stream:
+        config = yaml.safe_load(stream)
+    with open(getattr(args, GRAPHQL_CMS_CONFIG_KEY), 'r') as stream:
+        config_graphql = yaml.safe_load(stream)
+
+    main(config, config_graphql, getattr(args, NUMBER_KEY),
+         stream=getattr(args, STREAM_KEY), page_size=getattr(args, PAGE_SIZE_KEY))
@@ -1,13 +1,14 @@
 from apiclient import discovery
+from common import gcs
 from datetime import timedelta, date, datetime
-from google.cloud import storage
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
 from mergedeep import merge, Strategy
 import argparse
-import gzip
+import heapq
 import json
 import logging
+import post_cache
 import yaml
 
 
@@ -57,24 +58,23 @@ def create_authenticated_k5_client(config_graphql: dict) -> Client:
     )
 
 
-def gql_query_from_slugs(config_graphql: dict, file_host_domain_rule: dict, slugs: list) -> list:
-    slug_cond = ','.join([f'{{slug: "{slug}" }}' for slug in slugs])
-
-    gql_query = f"""
-    query{{ 
-        allPosts(where: {{OR:[ {slug_cond} ] }}){{
+def gql_query_from_slugs(config_graphql: dict, file_host_domain_rule: dict, slugs: list, gql_client: Client = None) -> list:
+    gql_query = """
+    query($slugs: [String]) {
+        allPosts(where: {slug_in: $slugs}) {
             id
-            heroImage {{urlMobileSized, urlTinySized}}
+            heroImage {urlMobileSized, urlTinySized}
             name
             publishTime
             slug
             source
-        }}
-    }}
+        }
+    }
     """
 
-    gql_client = create_authenticated_k5_client(config_graphql)
-    r = gql_client.execute(gql(gql_query))
+    if gql_client is None:
+        gql_client = create_authenticated_k5_client(config_graphql)
+    r = gql_client.execute(gql(gql_query), variable_values={'slugs': slugs})
 
     data = r['allPosts']
     for item in data:
@@ -87,6 +87,26 @@ def gql_query_from_slugs(config_graphql: dict, file_host_domain_rule: dict, slug
     return data
 
 
+def get_posts(config_graphql: dict, file_host_domain_rule: dict, slugs: list, cache: post_cache.PostCache, gql_client: Client = None) -> dict:
+    '''get_posts returns the posts of the slugs by slug, only the slugs missing from the cache or expired are queried with gql_client, or a new login without it'''
+    posts = {}
+    missing_slugs = []
+    for slug in slugs:
+        post = cache.get(slug)
+        if post is None:
+            missing_slugs.append(slug)
+        else:
+            posts[slug] = post
+
+    if len(missing_slugs) > 0:
+        for post in gql_query_from_slugs(config_graphql, file_host_domain_rule, missing_slugs, gql_client):
+            cache.put(post)
+            posts[post['slug']] = post
+    print(
+        f'post cache: {cache.hits} hits and {cache.misses} misses, {len(missing_slugs)} slugs are queried')
+    return posts
+
+
 def initialize_analyticsreporting() -> discovery.Resource:
     '''Initializes an analyticsreporting service object.
 
@@ -100,8 +120,12 @@ def initialize_analyticsreporting() -> discovery.Resource:
     return analytics
 
 
-def get_report(analytics: discovery.Resource, analytics_id: str, page_path_level1_regex_filter: list, additional_dimension_filters: list, page_size: int, date_range: tuple) -> dict:
-    # Use the Analytics Service Object to query the Analytics Reporting API V4.
+# the Analytics Reporting API takes at most 5 report requests in a batchGet
+MAX_REPORT_REQUESTS = 5
+
+
+def build_report_request(analytics_id: str, page_path_level1_regex_filter: list, additional_dimension_filters: list, page_size: int, date_range: tuple, extra_dimensions: list = []) -> dict:
+    '''build_report_request builds the report request of the pageviews by ga:pagePathLevel2, the extra dimensions are appended after the dimensions of the filters'''
     dimensions = [{'name': 'ga:pagePathLevel2'}]
     dimension_filters = [
         {
@@ -122,66 +146,106 @@ def get_report(analytics: discovery.Resource, analytics_id: str, page_path_level
                                                                                 'operator') != None else 'REGEXP',
                 'expressions': additional_dimension_filter['expressions'],
             })
-    print(f'requesting report in {date_range}')
-    return analytics.reports().batchGet(
-        body={
-            'reportRequests': [
-                {
-                    'viewId': analytics_id,
-                    'dateRanges': [{'startDate': date_range[0], 'endDate': date_range[-1]}],
-                    'metrics': [
-                        {'expression': 'ga:pageviews'}
-                    ],
-                    'orderBys': [{'fieldName': 'ga:pageviews', 'sortOrder': 'DESCENDING'}],
-                    'dimensions': dimensions,
-                    'dimensionFilterClauses': [
-                        {
-                            'operator': 'AND',
-                            'filters': dimension_filters
-                        }
-                    ],
-                    'pageSize': page_size,
-                }]
-        }
-    ).execute()
-
-
-def upload_blob(bucket_name: str, destination_blob_name: str, report: bytes):
-    '''Uploads a string to the bucket.'''
-    # destination_blob_name = 'storage-object-name'
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(f'json/{destination_blob_name}')
-
-    blob.content_encoding = 'gzip'
-    blob.upload_from_string(
-        data=gzip.compress(data=report, compresslevel=9), content_type='application/json; charset=utf-8', client=storage_client)
-    blob.content_language = 'zh'
-    blob.cache_control = 'max-age=300,public'
-    blob.patch()
-
-    print(
-        f'Report is uploaded to bucket://{bucket_name}/json/{destination_blob_name}')
+    dimensions.extend([{'name': dimension} for dimension in extra_dimensions])
+    return {
+        'viewId': analytics_id,
+        'dateRanges': [{'startDate': date_range[0], 'endDate': date_range[-1]}],
+        'metrics': [
+            {'expression': 'ga:pageviews'}
+        ],
+        'orderBys': [{'fieldName': 'ga:pageviews', 'sortOrder': 'DESCENDING'}],
+        'dimensions': dimensions,
+        'dimensionFilterClauses': [
+            {
+                'operator': 'AND',
+                'filters': dimension_filters
+            }
+        ],
+        'pageSize': page_size,
+    }
 
 
-def convert_response_to_report(config_graphql: dict, slugBlacklist: list, date_range: tuple, response: dict) -> str:
-    '''Parse the response and generate the json format file for it'''
+def get_reports(analytics: discovery.Resource, report_requests: list, max_pages: int = 10) -> list:
+    '''
+    get_reports sends the report requests in as few batchGet as possible and returns their reports in the same order.
+    The rows beyond the pageSize of a request are requested by its nextPageToken, up to max_pages pages per report.
+    A report still having more rows is truncated and reported, the pageviews summed from it are approximate.
+    '''
+    reports = [None] * len(report_requests)
+    page_tokens = {}
+    pending = list(range(len(report_requests)))
+    for _ in range(max_pages):
+        for i in range(0, len(pending), MAX_REPORT_REQUESTS):
+            indexes = pending[i:i + MAX_REPORT_REQUESTS]
+            batch = [dict(report_requests[index], pageToken=page_tokens[index])
+                     if index in page_tokens else report_requests[index] for index in indexes]
+            print(
+                f'requesting {len(batch)} reports in {[r["dateRanges"][0] for r in batch]}')
+            for index, report in zip(indexes, analytics.reports().batchGet(body={'reportRequests': batch}).execute()['reports']):
+                if reports[index] is None:
+                    reports[index] = report
+                else:
+                    reports[index]['data'].setdefault('rows', []).extend(
+                        report['data'].get('rows', []))
+                if report.get('nextPageToken'):
+                    page_tokens[index] = report['nextPageToken']
+                else:
+                    page_tokens.pop(index, None)
+        pending = [index for index in pending if index in page_tokens]
+        if len(pending) == 0:
+            break
+
+    for report in reports:
+        rows = len(report['data'].get('rows', []))
+        if report['data'].get('rowCount', rows) > rows:
+            print(
+                f'[WARNING] the report is truncated to {rows} of {report["data"]["rowCount"]} rows, the pageviews are approximate. Raise report.rowLimit or report.maxReportPages')
+    return reports
+
+
+def sum_daily_pageviews(report: dict, slug_blacklist: list, group_by: bool = False) -> tuple:
+    '''
+    sum_daily_pageviews sums the pageviews of the rows of a report with ga:date as the last dimension, to {slug: {yyyymmdd: pageviews}}.
+    With group_by, the dimension before ga:date is the group, and the pageviews of every group are summed as well.
+    It returns the pageviews of all the rows and {group: pageviews of the group}.
+    '''
+    blacklist = set(slug_blacklist)
+    daily_pageviews = {}
+    grouped_daily_pageviews = {}
+    for row in report['data'].get('rows', []):
+        slug = row['dimensions'][0].replace('/', '')
+        if slug in blacklist:
+            continue
+        day = row['dimensions'][-1]
+        views = int(row['metrics'][0]['values'][0])
+        targets = [daily_pageviews]
+        if group_by:
+            targets.append(grouped_daily_pageviews.setdefault(
+                row['dimensions'][-2], {}))
+        for target in targets:
+            slug_pageviews = target.setdefault(slug, {})
+            slug_pageviews[day] = slug_pageviews.get(day, 0) + views
+    return daily_pageviews, grouped_daily_pageviews
+
+
+def get_top_slugs(daily_pageviews: dict, date_range: tuple, page_size: int) -> list:
+    '''get_top_slugs returns the page_size slugs with the most pageviews in the date range'''
+    start, end = [d.replace('-', '') for d in (date_range[0], date_range[-1])]
+    pageviews = {slug: sum([views for day, views in days.items() if start <= day <= end])
+                 for slug, days in daily_pageviews.items()}
+    return heapq.nlargest(page_size, [slug for slug, views in pageviews.items() if views > 0], key=lambda slug: pageviews[slug])
+
+
+def format_report(posts: list, date_range: tuple) -> str:
+    '''
+    format_report generates the json of the report of the posts.
+    generate_time is the end date of the report in the format of datetime, so an unchanged report has the same json and its upload is skipped.
+    '''
     result = {}
-    data = []
-    if 'rows' in response['reports'][0]['data']:
-        data.extend(response['reports'][0]['data']['rows'])
-        data = sorted(
-            data, key=lambda x: int(x['metrics'][0]['values'][0]), reverse=True)
-
-    slugs = [item['dimensions'][0].replace(
-        '/', '') for item in data if item['dimensions'][0].replace('/', '') not in slugBlacklist]
-
-    result['report'] = gql_query_from_slugs(
-        config_graphql, config['report']['fileHostDomainRule'], slugs)
+    result['report'] = posts
     result['start_date'] = str(date_range[0])
     result['end_date'] = str(date_range[-1])
-    result['generate_time'] = str(datetime.now())
+    result['generate_time'] = str(datetime.fromisoformat(str(date_range[-1])))
 
     return json.dumps(result, ensure_ascii=False)
 
@@ -212,7 +276,28 @@ __default_graphql_cms_config = {
 }
 
 
-def main(config: dict, config_graphql: dict, days: int):
+def get_windows(config: dict, days: int) -> list:
+    '''get_windows returns the windows of report.windows, or the window of days with the report config when there is none'''
+    windows = config['report'].get('windows')
+    if windows is None:
+        windows = [{'days': days}]
+    return [{
+        'days': window['days'] if window['days'] >= 0 else 1,
+        'pageSize': window.get('pageSize', config['report']['pageSize']),
+        'fileName': window.get('fileName', config['report']['fileName']),
+    } for window in windows]
+
+
+def main(config: dict, config_graphql: dict, days: int = 1, gql_client: Client = None):
+    '''
+    main generates the popular reports of all the windows, e.g. 1, 7 and 30 days, by one GA report and one CMS query.
+    The Reporting API requires the requests of a batchGet to share the date range, so the pageviews are requested by day over the longest window
+    and summed for every window in memory. The report is paged by report.rowLimit rows, up to report.maxReportPages pages.
+    Beyond that the least viewed (slug, day) rows are dropped, so the lists are approximate and a warning is printed.
+    With report.groupBy, the pageviews by the dimension of the groups, e.g. the section, are requested by a second GA report over groupBy.days,
+    paged the same way, and every group has its own report as well.
+    The CMS is queried with gql_client when it is given, e.g. by the scheduler, instead of a new login.
+    '''
     print(f'{__file__} is executing...')
 
     # merge option to the default configs
@@ -220,21 +305,65 @@ def main(config: dict, config_graphql: dict, days: int):
                    strategy=Strategy.TYPESAFE_REPLACE)
     config_graphql = merge({}, __default_graphql_cms_config, config_graphql,
                            strategy=Strategy.TYPESAFE_REPLACE)
-    if days < 0:
-        days = 1
+    windows = get_windows(config, days)
+    group_by = config['report'].get('groupBy')
 
     today = date.today()
-    date_range = (str(today - timedelta(days=days)), str(today))
+    for window in windows:
+        window['dateRange'] = (
+            str(today - timedelta(days=window['days'])), str(today))
+    longest_date_range = (
+        str(today - timedelta(days=max([window['days'] for window in windows]))), str(today))
 
     analytics = initialize_analyticsreporting()
-    response = get_report(
-        analytics, config['analyticsID'], config['report']['pagePathLevel1RegexFilter'], config['report']['additionalDimensionFilters'], config['report']['pageSize'], date_range)
-    print(f'ga response:{response}')
-    report = convert_response_to_report(
-        config_graphql, config['slugBlacklist'], date_range, response)
-    print(f'report generated: {report}')
-    upload_blob(
-        bucket_name=config['report']['bucketName'], destination_blob_name=config['report']['fileName'], report=report.encode('utf-8'))
+    max_report_pages = config['report'].get('maxReportPages', 10)
+    report_request = build_report_request(
+        config['analyticsID'], config['report']['pagePathLevel1RegexFilter'], config['report']['additionalDimensionFilters'],
+        config['report'].get('rowLimit', 10000), longest_date_range, extra_dimensions=['ga:date'])
+    daily_pageviews, _ = sum_daily_pageviews(
+        get_reports(analytics, [report_request], max_report_pages)[0], config['slugBlacklist'])
+
+    for window in windows:
+        window['slugs'] = get_top_slugs(
+            daily_pageviews, window['dateRange'], window['pageSize'])
+
+    # every group keeps its own top pageSize slugs
+    if group_by is not None:
+        # the group dimension multiplies the rows, so the groups have their own report over their own days instead of the longest window
+        group_date_range = (
+            str(today - timedelta(days=group_by.get('days', 1))), str(today))
+        group_report_request = build_report_request(
+            config['analyticsID'], config['report']['pagePathLevel1RegexFilter'], config['report']['additionalDimensionFilters'],
+            config['report'].get('rowLimit', 10000), group_date_range, extra_dimensions=[group_by['dimensionName'], 'ga:date'])
+        _, grouped_daily_pageviews = sum_daily_pageviews(
+            get_reports(analytics, [group_report_request], max_report_pages)[0], config['slugBlacklist'], True)
+        allowed_groups = group_by.get('groups')
+        for group, group_daily_pageviews in grouped_daily_pageviews.items():
+            if group == '(not set)' or (allowed_groups is not None and group not in allowed_groups):
+                continue
+            windows.append({
+                'days': group_by.get('days', 1),
+                'dateRange': group_date_range,
+                'fileName': group_by.get('fileName', 'popularlist-{group}.json').format(group=group.replace('/', '-')),
+                'slugs': get_top_slugs(group_daily_pageviews, group_date_range, group_by.get('pageSize', config['report']['pageSize'])),
+            })
+
+    # the posts of all the windows are queried at once
+    slugs = list(dict.fromkeys(
+        [slug for window in windows for slug in window['slugs']]))
+    cache = post_cache.from_config(config['report'].get('postCache'))
+    posts = get_posts(
+        config_graphql, config['report']['fileHostDomainRule'], slugs, cache, gql_client)
+    cache.save()
+
+    uploads = []
+    for window in windows:
+        report = format_report([posts[slug] for slug in window['slugs'] if slug in posts],
+                               window['dateRange'])
+        print(f'report generated for {window["fileName"]}: {report}')
+        uploads.append({'bucket_name': config['report']['bucketName'], 'destination_blob_name': f'json/{window["fileName"]}',
+                        'data': report.encode('utf-8'), 'content_type': 'application/json; charset=utf-8'})
+    return gcs.get_publisher().upload_many(uploads)
 
 
 CONFIG_KEY = 'config'
@@ -249,7 +378,7 @@ if __name__ == '__main__':
     parser.add_argument('-g', '--config-graphql', dest=GRAPHQL_CMS_CONFIG_KEY,
                         help='graphql config file for generatePopularArticles', metavar='FILE', type=str, required=True)
     parser.add_argument('-d', '--days', dest=DAYS_KEY,
-                        help='the number of days for the report before now', metavar='2', type=int, required=True)
+                        help='the number of days for the report before now, ignored when report.windows is configured', metavar='2', type=int, default=1)
 
     args = parser.parse_args()
 
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from common import gcs
+import json
+import os
+import time
+
+
+class PostCache:
+    '''
+    PostCache keeps the CMS metadata of the popular posts by slug across the runs, so that only the new or expired slugs are queried.
+    The posts are stored after CDN() rewrites their hero image urls. An entry expires ttl seconds after it is stored,
+    and the least recently used slugs are evicted once there are more than max_size of them.
+    The cache is saved to a local file at path, and to gs://gcs_bucket/path when gcs_bucket is set so that a new pod starts warm.
+    Without a path the cache lives in memory only.
+    '''
+
+    def __init__(self, path: str = None, max_size: int = 2000, ttl: int = 3600, gcs_bucket: str = None):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.gcs_bucket = gcs_bucket
+        self.posts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def get_bucket(self):
+        return gcs.get_publisher().client.bucket(self.gcs_bucket)
+
+    def load(self):
+        if self.path is None:
+            return
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        elif self.gcs_bucket:
+            blob = self.get_bucket().get_blob(self.path)
+            entries = json.loads(blob.download_as_bytes().decode(
+                'utf-8')) if blob is not None else []
+        else:
+            entries = []
+
+        # entries are saved from the least recently used one
+        for slug, post, stored_at in entries:
+            self.put(post, stored_at)
+
+    def save(self):
+        if self.path is None:
+            return
+        data = json.dumps([[slug, post, stored_at] for slug, (post, stored_at) in self.posts.items()],
+                          ensure_ascii=False)
+
+        # write to a temporary file first so that an interrupted run never leaves a broken cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+        if self.gcs_bucket:
+            self.get_bucket().blob(self.path).upload_from_string(
+                data=data.encode('utf-8'), content_type='application/json; charset=utf-8')
+
+    def get(self, slug: str, now: float = None) -> dict:
+        now = now if now is not None else time.time()
+        post, stored_at = self.posts.get(slug, (None, 0))
+        if post is None or now - stored_at > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.posts.move_to_end(slug)
+        return post
+
+    def put(self, post: dict, stored_at: float = None):
+        self.posts[post['slug']] = (
+            post, stored_at if stored_at is not None else time.time())
+        self.posts.move_to_end(post['slug'])
+        while len(self.posts) > self.max_size:
+            self.posts.popitem(last=False)
+
+
+def from_config(cache_config: dict) -> PostCache:
+    '''from_config creates the persistent cache of the postCache config, or an in-memory one when it is not configured'''
+    if cache_config is None:
+        return PostCache()
+    return PostCache(path=cache_config['path'], max_size=cache_config.get('maxSize', 2000),
+                     ttl=cache_config.get('ttl', 3600), gcs_bucket=cache_config.get('gcsBucket'))
@@ -0,0 +1,274 @@
+from common import gcs
+from datetime import date, datetime
+from gql import Client
+from mergedeep import merge, Strategy
+import argparse
+import generatePopularArticles
+import glob
+import heapq
+import json
+import math
+import os
+import post_cache
+import queue
+import re
+import signal
+import threading
+import time
+import yaml
+
+'''
+trending keeps the popular list up to date from the pageview events instead of the GA reports, which take hours to be processed.
+Every event adds a weight decaying by half every halfLifeSeconds to the counter of its slug, so a breaking story climbs the list in a minute
+and fades out after it. The list is published in the same json as the reports of generatePopularArticles.
+'''
+
+
+class DecayedTopK:
+    '''
+    DecayedTopK counts the exponentially decayed pageviews of at most capacity slugs and returns the top ones.
+    The weights are stored relative to a base time, so an event only updates its own counter and the ranking needs no decay pass.
+    When all the counters are taken, the smallest one is replaced by the new slug, which inherits its count like the Space-Saving algorithm,
+    so a slug in the top has its count overestimated by at most the smallest count.
+    '''
+
+    def __init__(self, half_life: float, capacity: int, base_time: float = None):
+        self.decay_rate = math.log(2) / half_life
+        self.capacity = capacity
+        self.base_time = base_time if base_time is not None else time.time()
+        self.counts = {}
+        # the heap may have stale entries of the updated counters, they are skipped when they are popped
+        self.heap = []
+
+    def add(self, slug: str, timestamp: float, weight: float = 1):
+        # the stored weights grow with the time, so they are rebased before they overflow
+        if self.decay_rate * (timestamp - self.base_time) > 500:
+            self.rebase(timestamp)
+        weight = weight * math.exp(self.decay_rate *
+                                   (timestamp - self.base_time))
+
+        if slug not in self.counts and len(self.counts) >= self.capacity:
+            smallest_slug, smallest_count = self.pop_smallest()
+            del self.counts[smallest_slug]
+            weight += smallest_count
+        self.counts[slug] = self.counts.get(slug, 0) + weight
+        heapq.heappush(self.heap, (self.counts[slug], slug))
+
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, slug) for slug, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def pop_smallest(self) -> tuple:
+        while True:
+            count, slug = heapq.heappop(self.heap)
+            if self.counts.get(slug) == count:
+                return slug, count
+
+    def rebase(self, base_time: float):
+        factor = math.exp(-self.decay_rate * (base_time - self.base_time))
+        self.counts = {slug: count * factor for slug,
+                       count in self.counts.items()}
+        self.heap = [(count, slug) for slug, count in self.counts.items()]
+        heapq.heapify(self.heap)
+        self.base_time = base_time
+
+    def top(self, k: int, now: float = None) -> list:
+        '''top returns the k slugs with the largest counts and their pageviews decayed to now'''
+        now = now if now is not None else time.time()
+        factor = math.exp(-self.decay_rate * (now - self.base_time))
+        return [(slug, count * factor) for slug, count in heapq.nlargest(k, self.counts.items(), key=lambda item: item[1])]
+
+
+class NdjsonTailer:
+    '''
+    NdjsonTailer reads the events appended to the newline-delimited json files of the glob pattern since the last poll.
+    The files found by the first poll are read from their end, older events are not trending anymore, and the files created later from their start.
+    At most max_bytes are read from a file per poll, the rest is read by the next polls.
+    '''
+
+    def __init__(self, pattern: str, max_bytes: int = 1024 * 1024):
+        self.pattern = pattern
+        self.max_bytes = max_bytes
+        self.offsets = None
+
+    def poll(self) -> list:
+        paths = sorted(glob.glob(self.pattern))
+        if self.offsets is None:
+            self.offsets = {}
+            for path in paths:
+                try:
+                    self.offsets[path] = os.path.getsize(path)
+                except OSError:
+                    pass
+            return []
+
+        events = []
+        # the offsets of the removed files are dropped, a file created again with the same name is read from its start
+        self.offsets = {path: offset for path,
+                        offset in self.offsets.items() if path in paths}
+        for path in paths:
+            try:
+                events.extend(self.read(path))
+            except OSError as e:
+                # the file may be rotated between glob and open, it is read again by the next poll
+                print(f'[{__name__}] failed to read {path}: {repr(e)}')
+        return events
+
+    def read(self, path: str) -> list:
+        offset = self.offsets.get(path, 0)
+        # a file smaller than the offset has been truncated or rotated
+        if os.path.getsize(path) < offset:
+            offset = 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(self.max_bytes)
+        # a line without the newline is still being written, or is beyond max_bytes, it is read by the next poll
+        complete = data[:data.rfind(b'\n') + 1]
+        if len(complete) == 0 and len(data) == self.max_bytes:
+            print(f'[{__name__}] skip the line longer than {self.max_bytes} bytes in {path}')
+            complete = data
+        self.offsets[path] = offset + len(complete)
+
+        events = []
+        for line in complete.splitlines():
+            if line.strip():
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    print(f'[{__name__}] skip the broken event in {path}: {line[:200]}')
+        return events
+
+
+def drain_queue(events_queue: queue.Queue) -> list:
+    '''drain_queue takes the events put in the queue since the last poll, the queue stands in for a message broker'''
+    events = []
+    while True:
+        try:
+            events.append(events_queue.get_nowait())
+        except queue.Empty:
+            return events
+
+
+def parse_event(event: dict, path_pattern: re.Pattern, slug_blacklist: set, now: float) -> tuple:
+    '''
+    parse_event returns the slug and the time of a pageview event, or None when it is not a pageview of a story.
+    An event has the slug, or the path like /story/{slug}/, and the optional timestamp in epoch seconds or ISO 8601.
+    '''
+    if not isinstance(event, dict):
+        return None
+    slug = event.get('slug')
+    if slug is None:
+        match = path_pattern.match(event.get('path', ''))
+        if match is None:
+            return None
+        slug = match.group(1)
+    if slug in slug_blacklist:
+        return None
+
+    timestamp = event.get('timestamp', now)
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(
+            timestamp.replace('Z', '+00:00')).timestamp()
+    # an event from the future would outweigh all the others
+    return slug, min(timestamp, now)
+
+
+def publish(config: dict, trending_config: dict, config_graphql: dict, trending: DecayedTopK, cache: post_cache.PostCache, now: float, gql_client: Client = None) -> dict:
+    '''publish uploads the top slugs with their metadata in the json of the popular reports, the posts are queried with gql_client'''
+    slugs = [slug for slug, _ in trending.top(trending_config['topK'], now)]
+    posts = generatePopularArticles.get_posts(
+        config_graphql, config['report']['fileHostDomainRule'], slugs, cache, gql_client) if len(slugs) > 0 else {}
+    date_range = (str(date.fromtimestamp(
+        now - trending_config['halfLifeSeconds'])), str(date.fromtimestamp(now)))
+    report = generatePopularArticles.format_report(
+        [posts[slug] for slug in slugs if slug in posts], date_range)
+    return gcs.get_publisher().upload(bucket_name=config['report']['bucketName'], destination_blob_name=f'json/{trending_config["fileName"]}',
+                                      data=report.encode('utf-8'), content_type='application/json; charset=utf-8')
+
+
+__default_trending_config = {
+    'eventFiles': '',
+    'pathPattern': '^/story/([^/]+)/?$',
+    'halfLifeSeconds': 600,
+    'topK': 20,
+    'capacity': 1000,
+    'pollIntervalSeconds': 1,
+    'maxBytesPerPoll': 1048576,
+    'publishIntervalSeconds': 10,
+    'fileName': 'trendinglist.json',
+}
+
+
+def main(config: dict, config_graphql: dict, events_queue: queue.Queue = None, stopped: threading.Event = None):
+    '''
+    main consumes the events of trending.eventFiles, or of events_queue when it is given, and publishes the trending list
+    every publishIntervalSeconds until stopped is set.
+    '''
+    print(f'{__file__} is executing...')
+
+    # the intervals may be given as int or float
+    trending_config = merge({}, __default_trending_config, config.get('trending', {}),
+                            strategy=Strategy.REPLACE)
+    stopped = stopped if stopped is not None else threading.Event()
+
+    path_pattern = re.compile(trending_config['pathPattern'])
+    slug_blacklist = set(config.get('slugBlacklist', []))
+    trending = DecayedTopK(
+        trending_config['halfLifeSeconds'], trending_config['capacity'])
+    cache = post_cache.from_config(config['report'].get('postCache'))
+    tailer = NdjsonTailer(trending_config['eventFiles'], trending_config['maxBytesPerPoll']) if events_queue is None else None
+    # one login is shared by all the publishes, it is done again only after a publish fails
+    gql_client = None
+
+    next_publish = time.time()
+    while not stopped.is_set():
+        now = time.time()
+        events = tailer.poll() if tailer is not None else drain_queue(events_queue)
+        for event in events:
+            # a malformed event is skipped, it must not stop the daemon
+            try:
+                pageview = parse_event(
+                    event, path_pattern, slug_blacklist, now)
+                if pageview is not None:
+                    trending.add(*pageview)
+            except Exception as e:
+                print(f'skip the invalid event {repr(event)[:200]}: {repr(e)}')
+
+        if now >= next_publish:
+            next_publish = now + trending_config['publishIntervalSeconds']
+            try:
+                if gql_client is None:
+                    gql_client = generatePopularArticles.create_authenticated_k5_client(
+                        config_graphql)
+                publish(config, trending_config, config_graphql,
+                        trending, cache, now, gql_client)
+                cache.save()
+            except Exception as e:
+                # the counters are kept, so the list is published again by the next interval, with a new login in case the token has expired
+                gql_client = None
+                print(f'failed to publish the trending list: {repr(e)}')
+        stopped.wait(trending_config['pollIntervalSeconds'])
+
+
+CONFIG_KEY = 'config'
+GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Process configuration of trending')
+    parser.add_argument('-c', '--config', dest=CONFIG_KEY,
+                        help='config file for generatePopularArticles with the trending config', metavar='FILE', type=str, required=True)
+    parser.add_argument('-g', '--config-graphql', dest=GRAPHQL_CMS_CONFIG_KEY,
+                        help='graphql config file for generatePopularArticles', metavar='FILE', type=str, required=True)
+
+    args = parser.parse_args()
+
+    with open(getattr(args, CONFIG_KEY), 'r') as stream:
+        config = yaml.safe_load(stream)
+    with open(getattr(args, GRAPHQL_CMS_CONFIG_KEY), 'r') as stream:
+        config_graphql = yaml.safe_load(stream)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    main(config, config_graphql, stopped=stopped)
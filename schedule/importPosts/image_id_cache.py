@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+
+
+class ImageIdCache:
+    '''
+    ImageIdCache keeps the K5 image ids keyed by image name across the runs, so that the images imported before are not looked up again.
+    The least recently used names are evicted once there are more than max_size of them.
+    The cache is saved to a local file at path, and to gs://gcs_bucket/path when gcs_bucket is set so that a new pod starts warm.
+    Without a path the cache lives in memory only. It can be shared by threads.
+    '''
+
+    def __init__(self, path: str = None, max_size: int = 10000, gcs_bucket: str = None):
+        self.path = path
+        self.max_size = max_size
+        self.gcs_bucket = gcs_bucket
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.load()
+
+    def get_bucket(self):
+        # google-cloud-storage is only required when the cache is backed by GCS
+        from common import gcs
+        return gcs.get_publisher().client.bucket(self.gcs_bucket)
+
+    def load(self):
+        if self.path is None:
+            return
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        elif self.gcs_bucket:
+            blob = self.get_bucket().get_blob(self.path)
+            items = json.loads(blob.download_as_bytes().decode(
+                'utf-8')) if blob is not None else []
+        else:
+            items = []
+
+        # items are saved from the least recently used one
+        for name, id in items:
+            self.put(name, id)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(list(self.ids.items()), ensure_ascii=False)
+
+        # write to a temporary file first so that an interrupted run never leaves a broken cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+        if self.gcs_bucket:
+            self.get_bucket().blob(self.path).upload_from_string(
+                data=data.encode('utf-8'), content_type='application/json; charset=utf-8')
+
+    def get(self, name: str) -> str:
+        with self.lock:
+            id = self.ids.get(name)
+            if id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.ids.move_to_end(name)
+            return id
+
+    def put(self, name: str, id: str):
+        with self.lock:
+            self.ids[name] = id
+            self.ids.move_to_end(name)
+            while len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+    def invalidate(self, name: str):
+        with self.lock:
+            self.ids.pop(name, None)
+
+
+def from_config(cache_config: dict) -> ImageIdCache:
+    '''from_config creates the persistent cache of the imageIdCache config, or an in-memory one when it is not configured'''
+    if cache_config is None:
+        return ImageIdCache()
+    return ImageIdCache(path=cache_config['path'], max_size=cache_config.get('maxSize', 10000),
+                        gcs_bucket=cache_config.get('gcsBucket'))
@@ -1,3 +1,5 @@
+from common import existence, job_state
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
@@ -5,16 +7,23 @@ from mergedeep import merge, Strategy
 import __main__
 import aiohttp
 import argparse
+import asyncio
+import image_id_cache
 import io
 import json
 import logging
+import os
 import sys
-import urllib
+import threading
+import urllib.request
 import yaml
 
 CONFIG_KEY = 'config'
 GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
 MAX_NUMBER_KEY = 'maxNumber'
+BACKFILL_KEY = 'backfill'
+PAGE_SIZE_KEY = 'pageSize'
+WORKERS_KEY = 'workers'
 
 __default_config = {
     "sourceK3Endpoints":
@@ -42,19 +51,17 @@ __default_graphql_cms_config = {
     'apiEndpoint': '',
 }
 
-__query_existing_posts_template = '''query {
-  allPosts(where: {AND: [{OR: [%s]}]}) {
-    slug
-  }
-}
-'''
-
-
-def get_k3_posts(k3_endpoint: str, max_results: int = 20, sort: str = '-publishedDate', populate: str = 'categories,heroImage') -> dict:
-    '''getK3Posts get posts from k3'''
+def get_k3_posts(k3_endpoint: str, max_results: int = 20, sort: str = '-publishedDate', populate: str = 'categories,heroImage', page: int = 1, published_after: str = None) -> dict:
+    '''getK3Posts get posts from k3, only the ones published at or after published_after if it is given'''
     logger = logging.getLogger(__main__.__file__)
     logger.setLevel('INFO')
-    url = f'{k3_endpoint}?where={{"state":"published"}}&max_results={max_results}&sort={sort}&populate={populate}'
+    where = {'state': 'published'}
+    if published_after is not None:
+        # the posts published at the same time as the watermark are requested again and dropped by the existence check,
+        # $gt would skip the ones left beyond a full page
+        where['publishedDate'] = {'$gte': published_after}
+    where = urllib.parse.quote(json.dumps(where, separators=(',', ':')))
+    url = f'{k3_endpoint}?where={where}&max_results={max_results}&sort={sort}&populate={populate}&page={page}'
     logger.info(f'sending request:{url}')
     print
     req = urllib.request.Request(
@@ -68,20 +75,6 @@ def get_k3_posts(k3_endpoint: str, max_results: int = 20, sort: str = '-publishe
         return json.loads(f.read().decode('utf-8'))['_items']
 
 
-def find_existing_slugs_set(authenticated_graphql_client: Client, slugs: list = []) -> set:
-
-    # format query array
-    query_conditions = ','.join(
-        ['{slug: "%s"}' % slug for slug in slugs])
-    query = __query_existing_posts_template % query_conditions
-    logger.info(f'query slugs for existence...')
-    # extract slugs
-    existing_slugs = [post['slug'] for post in authenticated_graphql_client.execute(gql(query))[
-        'allPosts']]
-    logger.info(f'existing_slugs:{existing_slugs}')
-    return set(existing_slugs)
-
-
 def convert_hero_image(image_src: dict, post_dest: dict):
     if image_src != None:
         post_dest['heroImage'] = {
@@ -98,27 +91,25 @@ def convert_hero_image(image_src: dict, post_dest: dict):
 
 
 def convert_and_clean_post_for_k5(posts: list, delegated_writer: int) -> list:
+    '''convert_and_clean_post_for_k5 converts the k3 posts to the data of createPosts, which is sent as GraphQL variables'''
     new_posts = []
 
     for post in posts:
         new_post = {}
         convert_hero_image(post.get('heroImage', None), new_post)
-        new_post['briefJsonStr'] = json.dumps(json.dumps(
-            post['brief']['draft'], ensure_ascii=False), ensure_ascii=False)
-        new_post['briefApiDataJsonStr'] = json.dumps(json.dumps(
-            post['brief']['apiData'], ensure_ascii=False), ensure_ascii=False)
-        new_post['briefHtmlJsonStr'] = json.dumps(
-            post['brief']['html'], ensure_ascii=False)
-        new_post['contentJsonStr'] = json.dumps(json.dumps(
-            post['content']['draft'], ensure_ascii=False), ensure_ascii=False)
-        new_post['contentApiDataJsonStr'] = json.dumps(json.dumps(
-            post['content']['apiData'], ensure_ascii=False), ensure_ascii=False)
-        new_post['contentHtmlJsonStr'] = json.dumps(
-            post['content']['html'], ensure_ascii=False)
-        new_post['heroCaptionJsonStr'] = json.dumps(
-            post.get('heroCaption', None), ensure_ascii=False)
-        new_post['nameJsonStr'] = json.dumps(post['title'], ensure_ascii=False)
-        new_post['slugJsonStr'] = json.dumps(post['slug'], ensure_ascii=False)
+        new_post['brief'] = json.dumps(
+            post['brief']['draft'], ensure_ascii=False)
+        new_post['briefApiData'] = json.dumps(
+            post['brief']['apiData'], ensure_ascii=False)
+        new_post['briefHtml'] = post['brief']['html']
+        new_post['content'] = json.dumps(
+            post['content']['draft'], ensure_ascii=False)
+        new_post['contentApiData'] = json.dumps(
+            post['content']['apiData'], ensure_ascii=False)
+        new_post['contentHtml'] = post['content']['html']
+        new_post['heroCaption'] = post.get('heroCaption', None)
+        new_post['name'] = post['title']
+        new_post['slug'] = post['slug']
         new_post['writer'] = delegated_writer
         new_posts.append(new_post)
 
@@ -134,14 +125,10 @@ def is_section_allowed(section_name_blacklist: list, section: dict) -> bool:
     return section.get('name', None) not in set(section_name_blacklist)
 
 
-def create_authenticated_k5_client(config_graphql: dict) -> Client:
-    logger = logging.getLogger(__main__.__file__)
-    logger.setLevel('INFO')
+def authenticate_k5(config_graphql: dict) -> str:
     # Authenticate through GraphQL
-
-    gql_endpoint = config_graphql['apiEndpoint']
     gql_transport = AIOHTTPTransport(
-        url=gql_endpoint,
+        url=config_graphql['apiEndpoint'],
     )
     gql_client = Client(
         transport=gql_transport,
@@ -157,8 +144,10 @@ def create_authenticated_k5_client(config_graphql: dict) -> Client:
     mutation = qgl_mutation_authenticate_get_token % (
         config_graphql['username'], config_graphql['password'])
 
-    token = gql_client.execute(gql(mutation))['authenticate']['token']
+    return gql_client.execute(gql(mutation))['authenticate']['token']
 
+
+def create_k5_client(gql_endpoint: str, token: str) -> Client:
     gql_transport_with_token = AIOHTTPTransport(
         url=gql_endpoint,
         headers={
@@ -174,105 +163,167 @@ def create_authenticated_k5_client(config_graphql: dict) -> Client:
     )
 
 
+def create_authenticated_k5_client(config_graphql: dict) -> Client:
+    return create_k5_client(config_graphql['apiEndpoint'], authenticate_k5(config_graphql))
+
+
+def create_thread_k5_client(gql_endpoint: str, token: str) -> Client:
+    '''create_thread_k5_client creates the client used by a worker thread, gql runs the aiohttp transport in the event loop of the current thread'''
+    try:
+        asyncio.get_event_loop()
+    except RuntimeError:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    return create_k5_client(gql_endpoint, token)
+
+
+def create_existence_checker(config: dict, config_graphql: dict, token: str) -> existence.ExistenceChecker:
+    '''create_existence_checker creates the checker of the post slugs with the existenceCheck config'''
+    return existence.from_config(lambda: create_thread_k5_client(config_graphql['apiEndpoint'], token), config.get('existenceCheck'),
+                                 list_name='allPosts', key_field='slug', condition=lambda slugs: '{slug_in: %s}' % json.dumps(slugs, ensure_ascii=False))
+
+
 def convert_file_url_base(file_host_domain_rule: dict, url: str) -> str:
     for key in file_host_domain_rule.keys():
         url = url.replace(key, file_host_domain_rule[key], 1)
     return url
 
 
-__query_images_by_name_template = '''query {
-  allImages(where: {name: "%s"}) {
+__query_images_by_names_template = '''query($names: [String]) {
+  allImages(where: {name_in: $names}) {
     id
+    name
   }
 }
 '''
 
-__mutation_create_image_for_id_template = '''mutation {
-    allImages(where: {name: "%s"}) {
-        id
-    }
+__mutation_create_images_template = '''mutation($images: [ImagesCreateInput]) {
+  createImages(data: $images) {
+    id
+    name
+  }
+}
+'''
+
+__mutation_create_posts_template = '''mutation($posts: [PostsCreateInput]) {
+  createPosts(data: $posts) {
+    id
+    slug
+    name
+  }
 }
 '''
 
 
-def create_and_get_image_id(authenticated_graphql_client: Client, image: dict, file_host_domain_rule: dict) -> id:
+def create_and_get_image_ids(authenticated_graphql_client: Client, images: list, file_host_domain_rule: dict, cache: image_id_cache.ImageIdCache = None) -> dict:
+    '''
+    create_and_get_image_ids returns the ids of the images keyed by name. The names in the cache are not looked up,
+    the others are looked up in one query and the missing ones are created in one mutation.
+    '''
     logger = logging.getLogger(__main__.__file__)
     logger.setLevel('INFO')
-    query_image_ids_by_name = __query_images_by_name_template % image['name']
-    images = authenticated_graphql_client.execute(
-        gql(query_image_ids_by_name))['allImages']
-
-    if len(images) == 0:
-        # create images
+    cache = cache if cache is not None else image_id_cache.ImageIdCache()
+    images_by_name = {image['name']: image for image in images}
+
+    image_ids = {}
+    for name in images_by_name.keys():
+        id = cache.get(name)
+        if id is not None:
+            image_ids[name] = id
+
+    names_to_query = [
+        name for name in images_by_name.keys() if name not in image_ids]
+    if len(names_to_query) == 0:
+        return image_ids
+
+    for image in authenticated_graphql_client.execute(
+            gql(__query_images_by_names_template), variable_values={'names': names_to_query})['allImages']:
+        image_ids[image['name']] = image['id']
+        cache.put(image['name'], image['id'])
+
+    missing_images = [image for name, image in images_by_name.items()
+                      if name not in image_ids]
+    if len(missing_images) > 0:
         # FIXME it's a workaround to raise error on server side so that the image data won't be overwritten by the server
-        params = {"file": io.StringIO('')}
-        create_image_mutation = f'''
-        mutation($file: Upload!) {{
-            createImage (data:{{
-                name: {json.dumps(image['name'], ensure_ascii=False)},
-                file: $file,
-                meta: {json.dumps(image['meta'], ensure_ascii=False)},
-                urlOriginal: {json.dumps(image['urlOriginal'], ensure_ascii=False)},
-                urlDesktopSized: {json.dumps(convert_file_url_base(file_host_domain_rule, image['urlDesktopSized']), ensure_ascii=False)},
-                urlMobileSized: {json.dumps(convert_file_url_base(file_host_domain_rule, image['urlMobileSized']), ensure_ascii=False)},
-                urlTabletSized: {json.dumps(convert_file_url_base(file_host_domain_rule, image['urlTabletSized']), ensure_ascii=False)},
-                urlTinySized: {json.dumps(convert_file_url_base(file_host_domain_rule, image['urlTinySized']), ensure_ascii=False)},
-            }}) {{
-                name
-                id
-            }}
-        }}'''
-        created_image = authenticated_graphql_client.execute(
-            gql(create_image_mutation), variable_values=params, upload_files=True)['createImage']
-        id = created_image['id']
-        logger.info(
-            f'created image(id:{created_image["id"]}, name:{created_image["name"]})')
-    else:
-        id = images[0]['id']
-
-    return id
-
-
-def insert_post_to_k5(authenticated_graphql_client: Client, post: dict, source: str, file_host_domain_rule: dict):
+        params = {'images': [{'data': {
+            'name': image['name'],
+            'file': io.StringIO(''),
+            'meta': image['meta'],
+            'urlOriginal': image['urlOriginal'],
+            'urlDesktopSized': convert_file_url_base(file_host_domain_rule, image['urlDesktopSized']),
+            'urlMobileSized': convert_file_url_base(file_host_domain_rule, image['urlMobileSized']),
+            'urlTabletSized': convert_file_url_base(file_host_domain_rule, image['urlTabletSized']),
+            'urlTinySized': convert_file_url_base(file_host_domain_rule, image['urlTinySized']),
+        }} for image in missing_images]}
+        created_images = authenticated_graphql_client.execute(
+            gql(__mutation_create_images_template), variable_values=params, upload_files=True)['createImages']
+        for created_image in created_images:
+            image_ids[created_image['name']] = created_image['id']
+            cache.put(created_image['name'], created_image['id'])
+            logger.info(
+                f'created image(id:{created_image["id"]}, name:{created_image["name"]})')
+
+    return image_ids
+
+
+def convert_post_to_create_data(post: dict, source: str, hero_image_id: str) -> dict:
+    return {'data': {
+        'slug': post['slug'],
+        'name': post['name'],
+        'writers': {'connect': [{'id': post['writer']}]},
+        'heroImage': {'connect': {'id': hero_image_id}},
+        'heroCaption': post['heroCaption'],
+        'brief': post['brief'],
+        'briefHtml': post['briefHtml'],
+        'briefApiData': post['briefApiData'],
+        'content': post['content'],
+        'contentHtml': post['contentHtml'],
+        'contentApiData': post['contentApiData'],
+        'source': source,
+    }}
+
+
+def insert_posts_to_k5(authenticated_graphql_client: Client, source: str, file_host_domain_rule: dict, posts: list, chunk_size: int = 20, cache: image_id_cache.ImageIdCache = None, signout: bool = True):
+    '''
+    insert_posts_to_k5 creates the posts with hero images. All the hero images are looked up and created in bulk first,
+    then the posts are created by createPosts, chunk_size posts per mutation.
+    '''
     logger = logging.getLogger(__main__.__file__)
     logger.setLevel('INFO')
-    # check image existent
-    if post.get('heroImage') != None:
-        hero_image_id = create_and_get_image_id(authenticated_graphql_client, post.get(
-            'heroImage'), file_host_domain_rule)
-        create_post_mutation = f'''
-        mutation {{
-            createPost(data: {{
-                slug: {post["slugJsonStr"]},
-                name: {post["nameJsonStr"]},
-                writers: {{
-                    connect:{{
-                        id: {post['writer']}
-                    }}
-                }},
-                heroImage: {{
-                    connect: {{
-                        id: {hero_image_id}
-                        }}
-                    }},
-                heroCaption: {post["heroCaptionJsonStr"]},
-                brief: {post["briefJsonStr"]},
-                briefHtml: {post["briefHtmlJsonStr"]},
-                briefApiData: {post["briefApiDataJsonStr"]},
-                content: {post["contentJsonStr"]},
-                contentHtml: {post["contentHtmlJsonStr"]},
-                contentApiData: {post["contentApiDataJsonStr"]},
-                source: "{source}"
-            }}) {{
-                id
-                slug
-                name
-            }}
-        }}'''
-
-        created_post = authenticated_graphql_client.execute(
-            gql(create_post_mutation))['createPost']
-        logger.info(f'post created: {created_post}')
+    cache = cache if cache is not None else image_id_cache.ImageIdCache()
+    # only the posts with hero images are imported
+    posts = [post for post in posts if post.get('heroImage') != None]
+    cached_names = {post['heroImage']['name'] for post in posts
+                    if post['heroImage']['name'] in cache.ids}
+    image_ids = create_and_get_image_ids(authenticated_graphql_client, [
+                                         post['heroImage'] for post in posts], file_host_domain_rule, cache)
+
+    for i in range(0, len(posts), chunk_size):
+        chunk = posts[i:i + chunk_size]
+        try:
+            created_posts = authenticated_graphql_client.execute(gql(__mutation_create_posts_template), variable_values={
+                'posts': [convert_post_to_create_data(post, source, image_ids[post['heroImage']['name']]) for post in chunk]})['createPosts']
+        except Exception as e:
+            stale_names = {post['heroImage']['name']
+                           for post in chunk} & cached_names
+            if len(stale_names) == 0:
+                raise
+            # the cached ids may point to images deleted from the CMS, so they are looked up again and the chunk is retried once
+            logger.warning(
+                f'creating posts failed with cached image ids of {stale_names}: {repr(e)}')
+            for name in stale_names:
+                cache.invalidate(name)
+            cached_names -= stale_names
+            image_ids.update(create_and_get_image_ids(authenticated_graphql_client, [
+                post['heroImage'] for post in chunk if post['heroImage']['name'] in stale_names], file_host_domain_rule, cache))
+            created_posts = authenticated_graphql_client.execute(gql(__mutation_create_posts_template), variable_values={
+                'posts': [convert_post_to_create_data(post, source, image_ids[post['heroImage']['name']]) for post in chunk]})['createPosts']
+        for created_post in created_posts:
+            logger.info(f'post created: {created_post}')
+
+    logger.info(
+        f'image id cache: {cache.hits} hits and {cache.misses} misses in this run')
+    if signout:
+        k5_signout(authenticated_graphql_client)
 
 
 def k5_signout(authenticated_graphql_client: Client):
@@ -288,64 +339,304 @@ def k5_signout(authenticated_graphql_client: Client):
     logger.info(result)
 
 
-def insert_posts_to_k5(authenticated_graphql_client: Client, source: str, file_host_domain_rule: dict, posts: list):
+def prefix_posts(config: dict, posts: list) -> list:
+    '''prefix_posts prefixes the slugs and the hero image names of the k3 posts with destSlugPrefix'''
+    for post in posts:
+        post['slug'] = f'{config["destSlugPrefix"]}{post["slug"]}'
+        try:
+            post['heroImage'][
+                'description'] = f'{config["destSlugPrefix"]}{post["heroImage"]["description"]}'
+        except:
+            # in case of posts without heroimage
+            pass
+    return posts
+
+
+def is_post_allowed(config: dict, post: dict) -> bool:
+    return all([is_category_not_member_only(c) for c in post.get('categories', [])]) \
+        and all([is_section_allowed(config['blacklist']['sectionNames'], section) for section in post.get('sections', [])])
+
+
+def select_new_posts(config: dict, checker: existence.ExistenceChecker, posts: list) -> list:
+    '''select_new_posts returns the posts which are not in K5 yet and are allowed by the blacklist'''
     logger = logging.getLogger(__main__.__file__)
     logger.setLevel('INFO')
-    logger.info(f'login as {config_graphql["username"]}')
-    for post in posts:
-        insert_post_to_k5(authenticated_graphql_client,
-                          post, source, file_host_domain_rule)
 
-    k5_signout(authenticated_graphql_client)
+    existing_slugs_set = checker.find_existing(
+        [post['slug'] for post in posts])
+    logger.info(f'existing_slugs:{sorted(existing_slugs_set)}')
+
+    return [
+        post
+        for post in posts
+        if f'{post["slug"]}' not in existing_slugs_set and is_post_allowed(config, post)
+    ]
+
+
+def iter_k3_pages(k3_endpoint: str, page_size: int, start_page: int):
+    '''iter_k3_pages yields the pages of k3 posts from the oldest one. New posts are appended to the last page, so the number of a page stays the same.'''
+    page = start_page
+    while True:
+        posts = get_k3_posts(k3_endpoint=k3_endpoint,
+                             max_results=page_size, sort='publishedDate', page=page)
+        if len(posts) > 0:
+            yield page, posts
+        if len(posts) < page_size:
+            return
+        page += 1
 
 
-def main(config: dict = None, config_graphql: dict = None, playlist_ids: list = None, max_number: int = 3):
-    ''' Import YouTube Channel program starts here '''
+def backfill(config: dict = None, config_graphql: dict = None, page_size: int = 50, workers: int = 4):
+    '''
+    backfill imports the whole k3 archive page by page from the oldest post. The pages are imported by a pool of workers,
+    and the last page before which every page is imported is saved as the checkpoint, so that an interrupted backfill resumes from there.
+    At most two pages per worker are held in memory.
+    '''
     logger = logging.getLogger(__main__.__file__)
     logger.setLevel('INFO')
 
-    # merge option to the default configs
     config = merge({}, __default_config, config,
                    strategy=Strategy.TYPESAFE_REPLACE)
     config_graphql = merge({}, __default_graphql_cms_config, config_graphql,
                            strategy=Strategy.TYPESAFE_REPLACE)
-
+    checkpoint_config = config.get(
+        'backfillCheckpoint', {'path': 'backfill_checkpoint.json'})
+    checkpoint = job_state.load(checkpoint_config, {'page': 0})
+    logger.info(f'backfill starts after page {checkpoint["page"]}')
+
+    token = authenticate_k5(config_graphql)
+    cache = image_id_cache.from_config(config.get('imageIdCache'))
+    checker = create_existence_checker(config, config_graphql, token)
+    images_lock = threading.Lock()
+
+    def import_page(posts: list) -> int:
+        # every worker has its own client from the checker, gql clients are not thread-safe
+        new_posts = select_new_posts(
+            config, checker, prefix_posts(config, posts))
+        k5_posts = convert_and_clean_post_for_k5(
+            new_posts, config['writerID'])
+        # the hero images are resolved one page at a time, otherwise two pages with the same image would both create it
+        with images_lock:
+            create_and_get_image_ids(checker.get_client(), [post['heroImage'] for post in k5_posts if post.get(
+                'heroImage') != None], config['fileHostDomainRule'], cache)
+        insert_posts_to_k5(checker.get_client(), config['source'], config['fileHostDomainRule'],
+                           k5_posts, cache=cache, signout=False)
+        checker.add([post['slug'] for post in new_posts])
+        return len(new_posts)
+
+    pending = {}
+    done_pages = {}
+    failed_pages = []
+    imported = 0
+
+    def collect(future_done):
+        nonlocal imported
+        for future in future_done:
+            page, last_published_date = pending.pop(future)
+            try:
+                imported += future.result()
+                done_pages[page] = last_published_date
+            except Exception as e:
+                failed_pages.append(page)
+                logger.error(f'page {page} failed: {repr(e)}')
+        # the checkpoint only moves over the pages imported without a gap
+        advanced = False
+        while checkpoint['page'] + 1 in done_pages:
+            checkpoint['page'] += 1
+            checkpoint['publishedDate'] = done_pages.pop(checkpoint['page'])
+            advanced = True
+        if advanced:
+            job_state.save(checkpoint_config, checkpoint)
+            logger.info(
+                f'checkpoint: page {checkpoint["page"]}, publishedDate {checkpoint["publishedDate"]}, {imported} posts imported')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page, posts in iter_k3_pages(config['sourceK3Endpoints']['posts'], page_size, checkpoint['page'] + 1):
+            if len(pending) >= workers * 2:
+                future_done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(future_done)
+            pending[executor.submit(import_page, posts)] = (
+                page, posts[-1].get('publishedDate'))
+        collect(wait(pending).done)
+
+    cache.save()
+    checker.save()
+    checker.close()
+    k5_signout(create_k5_client(config_graphql['apiEndpoint'], token))
+    logger.info(
+        f'backfill imported {imported} posts, failed pages: {failed_pages}')
+
+
+def get_source_configs(config: dict) -> list:
+    '''get_source_configs returns the config of every source in config['sources'], which inherits the rest of config. Without sources, config is the only source.'''
+    shared_config = {key: value for key,
+                     value in config.items() if key != 'sources'}
+    source_configs = [merge({}, shared_config, source_config, strategy=Strategy.TYPESAFE_REPLACE)
+                      for source_config in config.get('sources', [{}])]
+    # a highWatermark shared by the sources would make them overwrite each other's state, so its path is made per source
+    if 'sources' in config and 'highWatermark' in shared_config:
+        for source_config, own_config in zip(source_configs, config['sources']):
+            if 'path' not in own_config.get('highWatermark', {}):
+                root, ext = os.path.splitext(
+                    shared_config['highWatermark']['path'])
+                source_config['highWatermark']['path'] = f'{root}-{source_config["source"]}{ext}'
+    return source_configs
+
+
+def fetch_source_posts(source_config: dict, max_number: int) -> tuple:
+    '''
+    fetch_source_posts gets the k3 posts of the source with their slugs prefixed, and the watermark to save once they are imported.
+    With the highWatermark config, only the posts published since the newest imported one are requested, from the oldest one.
+    Before the first watermark is saved, the newest posts are requested as without the config, and the watermark starts from them.
+    '''
     # 1. request https://api.mirrormedia.mg/getposts?where={"state": "published"}&max_results=100&sort=-publishedDate&populate=categories,heroImage
-    posts = get_k3_posts(
-        k3_endpoint=config['sourceK3Endpoints']['posts'], max_results=max_number)
-    # 2. Check post existence
-    posts_with_new_slug = posts
-    for i in range(len(posts_with_new_slug)):
-        posts_with_new_slug[i]['slug'] = f'{config["destSlugPrefix"]}{posts_with_new_slug[i]["slug"]}'
-        try:
-            posts_with_new_slug[i]['heroImage'][
-                'description'] = f'{config["destSlugPrefix"]}{posts_with_new_slug[i]["heroImage"]["description"]}'
-        except:
-            # in case of posts without heroimage
-            pass
-
-    authenticated_graphql_client = create_authenticated_k5_client(
-        config_graphql)
-
-    slugs = [post['slug'] for post in posts_with_new_slug]
-    existing_slugs_set = find_existing_slugs_set(
-        authenticated_graphql_client=authenticated_graphql_client, slugs=slugs)
-
-    new_posts = [
-        post
-        for post in posts_with_new_slug
-        if f'{post["slug"]}' not in existing_slugs_set
-        and all([is_category_not_member_only(c) for c in post.get('categories', [])])
-        and all([is_section_allowed(config['blacklist']['sectionNames'], section) for section in post.get('sections', [])])
-    ]
+    watermark_config = source_config.get('highWatermark')
+    watermark = job_state.load(
+        watermark_config, {}) if watermark_config is not None else {}
+    if watermark.get('publishedDate') is None:
+        posts = prefix_posts(source_config, get_k3_posts(
+            k3_endpoint=source_config['sourceK3Endpoints']['posts'], max_results=max_number))
+        newest_post = posts[0] if len(posts) > 0 else None
+    else:
+        # $gte returns the imported posts at the watermark again, so as many more posts are requested and those are dropped,
+        # an unchanged source has no post then. The older posts come first, so the ones beyond max_number are left to the next run.
+        imported_slugs = set(watermark.get('slugs', []))
+        posts = prefix_posts(source_config, get_k3_posts(k3_endpoint=source_config['sourceK3Endpoints']['posts'], max_results=max_number + len(imported_slugs),
+                                                         sort='publishedDate', published_after=watermark['publishedDate']))
+        posts = [post for post in posts if not (
+            post['publishedDate'] == watermark['publishedDate'] and post['slug'] in imported_slugs)][:max_number]
+        newest_post = posts[-1] if len(posts) > 0 else None
+
+    if watermark_config is None or len(posts) == 0:
+        return posts, None
+    # the order of k3 decides the newest post, the dates may not be comparable as strings
+    next_watermark = {'publishedDate': newest_post['publishedDate'], 'slugs': [
+        post['slug'] for post in posts if post['publishedDate'] == newest_post['publishedDate']]}
+    if next_watermark['publishedDate'] == watermark.get('publishedDate'):
+        next_watermark['slugs'] = list(dict.fromkeys(
+            watermark.get('slugs', []) + next_watermark['slugs']))
+    return posts, next_watermark
+
+
+def main(config: dict = None, config_graphql: dict = None, playlist_ids: list = None, max_number: int = 3, token: str = None):
+    '''
+    Import YouTube Channel program starts here.
+    The posts of all the sources are fetched concurrently and checked by one existence check, then inserted in chunks interleaved across the sources
+    by at most concurrency workers sharing one login, after the hero images of all the chunks are resolved once.
+    Nothing else is done when no source has a new post. A source failed to be fetched or imported fails the run after the others are imported.
+    The login is skipped when the token is given, e.g. by the scheduler, and the given token is not signed out as others share it.
+    '''
+    logger = logging.getLogger(__main__.__file__)
+    logger.setLevel('INFO')
 
-    logger.info(f'news post slugs:{[post["slug"] for post in new_posts]}')
-    # 3. Generate and clean up Posts for k5
-    k5_posts = convert_and_clean_post_for_k5(new_posts, config['writerID'])
-    logger.debug(f'posts generated for k5:{k5_posts}')
-    # 4. Insert post only or insert post and image together
-    insert_posts_to_k5(
-        authenticated_graphql_client, config['source'], config['fileHostDomainRule'], k5_posts)
+    # merge option to the default configs
+    config = merge({}, __default_config, config,
+                   strategy=Strategy.TYPESAFE_REPLACE)
+    config_graphql = merge({}, __default_graphql_cms_config, config_graphql,
+                           strategy=Strategy.TYPESAFE_REPLACE)
+    source_configs = get_source_configs(config)
+    concurrency = config.get('concurrency', 4)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(fetch_source_posts, source_config, max_number)
+                   for source_config in source_configs]
+        sources = []
+        watermarks = []
+        # a source failed to be fetched fails the run as well, after the other sources are imported
+        fetch_failed_sources = []
+        for source_config, future in zip(source_configs, futures):
+            try:
+                posts, watermark = future.result()
+                sources.append((source_config, posts))
+                watermarks.append(watermark)
+            except Exception as e:
+                fetch_failed_sources.append(source_config['source'])
+                logger.error(
+                    f'failed to fetch the posts of {source_config["source"]}: {repr(e)}')
+
+    if sum([len(posts) for _, posts in sources]) == 0:
+        if len(fetch_failed_sources) > 0:
+            raise Exception(
+                f'failed to fetch the posts of {fetch_failed_sources}')
+        logger.info('there is no new post in any source')
+        return
+
+    # 2. Check post existence of all the sources at once
+    signout = token is None
+    if signout:
+        token = authenticate_k5(config_graphql)
+    checker = create_existence_checker(config, config_graphql, token)
+    existing_slugs_set = checker.find_existing(
+        [post['slug'] for _, posts in sources for post in posts])
+    logger.info(f'existing_slugs:{sorted(existing_slugs_set)}')
+
+    # 3. Generate and clean up Posts for k5, a slug shared by the sources is imported once
+    chunk_size = config.get('insertChunkSize', 20)
+    seen_slugs = set(existing_slugs_set)
+    source_chunks = []
+    for source_config, posts in sources:
+        new_posts = []
+        for post in posts:
+            if post['slug'] not in seen_slugs and is_post_allowed(source_config, post):
+                seen_slugs.add(post['slug'])
+                new_posts.append(post)
+        logger.info(
+            f'news post slugs of {source_config["source"]}:{[post["slug"] for post in new_posts]}')
+        k5_posts = convert_and_clean_post_for_k5(
+            new_posts, source_config['writerID'])
+        logger.debug(f'posts generated for k5:{k5_posts}')
+        source_chunks.append([k5_posts[i:i + chunk_size]
+                             for i in range(0, len(k5_posts), chunk_size)])
+
+    # 4. Insert post only or insert post and image together, the chunks of the sources take turns
+    cache = image_id_cache.from_config(config.get('imageIdCache'))
+    failed_sources = set()
+
+    # the hero images are resolved before the chunks run concurrently, otherwise two chunks with the same image would both create it
+    for index, ((source_config, _), chunks) in enumerate(zip(sources, source_chunks)):
+        try:
+            create_and_get_image_ids(checker.get_client(), [post['heroImage'] for chunk in chunks for post in chunk if post.get(
+                'heroImage') != None], source_config['fileHostDomainRule'], cache)
+        except Exception as e:
+            failed_sources.add(index)
+            source_chunks[index] = []
+            logger.error(
+                f'failed to create the images of {source_config["source"]}: {repr(e)}')
+
+    def insert(source_config: dict, k5_posts: list):
+        insert_posts_to_k5(checker.get_client(), source_config['source'], source_config['fileHostDomainRule'],
+                           k5_posts, chunk_size=chunk_size, cache=cache, signout=False)
+        checker.add([post['slug'] for post in k5_posts])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for i in range(max([len(chunks) for chunks in source_chunks])):
+            for index, ((source_config, _), chunks) in enumerate(zip(sources, source_chunks)):
+                if i < len(chunks):
+                    futures.append((index, executor.submit(
+                        insert, source_config, chunks[i])))
+        for index, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed_sources.add(index)
+                logger.error(
+                    f'failed to insert posts of {sources[index][0]["source"]}: {repr(e)}')
+
+    cache.save()
+    checker.save()
+    checker.close()
+    if signout:
+        k5_signout(create_k5_client(config_graphql['apiEndpoint'], token))
+
+    # the watermark moves only after all the posts of the source are imported, so a failed source is retried from the same place
+    for index, ((source_config, _), watermark) in enumerate(zip(sources, watermarks)):
+        if watermark is not None and index not in failed_sources:
+            job_state.save(source_config['highWatermark'], watermark)
+
+    if len(failed_sources) > 0 or len(fetch_failed_sources) > 0:
+        raise Exception(
+            f'failed to import the posts of {[sources[index][0]["source"] for index in sorted(failed_sources)] + fetch_failed_sources}')
 
 
 logging.basicConfig()
@@ -362,6 +653,12 @@ if __name__ == '__main__':
                         help='graphql config file for importPosts', metavar='FILE', type=str, required=True)
     parser.add_argument('-m', '--max-number', dest=MAX_NUMBER_KEY,
                         help='max number of posts', metavar='10', type=int, required=True)
+    parser.add_argument('-b', '--backfill', dest=BACKFILL_KEY, action='store_true',
+                        help='import the whole k3 archive from the oldest post, resuming from the checkpoint of backfillCheckpoint')
+    parser.add_argument('-p', '--page-size', dest=PAGE_SIZE_KEY,
+                        help='number of k3 posts per page in the backfill', metavar='50', type=int, default=50)
+    parser.add_argument('-w', '--workers', dest=WORKERS_KEY,
+                        help='number of pages imported concurrently in the backfill', metavar='4', type=int, default=4)
 
     args = parser.parse_args()
 
@@ -371,6 +668,11 @@ if __name__ == '__main__':
         config_graphql = yaml.safe_load(stream)
     max_number = getattr(args, MAX_NUMBER_KEY)
 
-    main(config=config, config_graphql=config_graphql, max_number=max_number)
+    if getattr(args, BACKFILL_KEY):
+        backfill(config=config, config_graphql=config_graphql, page_size=getattr(
+            args, PAGE_SIZE_KEY), workers=getattr(args, WORKERS_KEY))
+    else:
+        main(config=config, config_graphql=config_graphql,
+             max_number=max_number)
 
     logger.info('exiting...good bye...')
@@ -1,3 +1,5 @@
+from common import existence, job_state
+from concurrent.futures import ThreadPoolExecutor
 from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
 from mergedeep import merge, Strategy
@@ -5,10 +7,11 @@ from urllib.parse import urlparse, parse_qs
 import argparse
 import json
 import os
-import requests
 import sys
+import time
 import urllib.request
 import yaml
+import ytrelay
 
 CONFIG_KEY = 'config'
 GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
@@ -21,6 +24,8 @@ __defaultConfig = {
         'playlistItems': 'http://yt-relay-tv-yt-relay/youtube/v3/playlistItems',
     },
     'converTextToDraftApiEndpoint': 'https://api.mirrormedia.mg/converttext',
+    'concurrency': 8,
+    'cacheTTL': 600,
 }
 
 __defaultgraphqlCmsConfig = {
@@ -29,13 +34,7 @@ __defaultgraphqlCmsConfig = {
     'apiEndpoint': '',
 }
 
-__queryExistingVideosTemplate = '''
-query {
-  allVideos(where: {AND: [{OR: [%s]}, {OR: [{url_contains_i: "youtube"}, {url_contains_i: "youtu.be"}]}]}) {
-    url
-  }
-}
-'''
+__youtubeVideosCondition = '{OR: [{url_contains_i: "youtube"}, {url_contains_i: "youtu.be"}]}'
 
 
 def convertTextToDraft(config: dict, s: str) -> tuple:
@@ -51,17 +50,112 @@ def convertTextToDraft(config: dict, s: str) -> tuple:
     return (j['draft'], j['html'], j['apiData'])
 
 
-def main(config: dict = None, configGraphQL: dict = None, playlistIds: list = None, maxNumber: int = 3):
-    ''' Import YouTube Channel program starts here '''
-    print(f'{__file__} is executing...')
+def fetchPlaylistItems(relay: ytrelay.YtRelayClient, ytrelayPlaylistItemsAPI: str, playlistId: str, maxNumber: int) -> list:
+    '''fetchPlaylistItems gets the latest maxNumber items of the playlist from yt-relay'''
+    params = dict(
+        part='snippet',
+        maxResults=maxNumber,
+        playlistId=playlistId,
+        fields='items(snippet/title,snippet/description,snippet/resourceId/videoId)'
+    )
+    resp = relay.get(url=ytrelayPlaylistItemsAPI, params=params)
 
-    # merge option to the default configs
-    config = merge({}, __defaultConfig, config,
-                   strategy=Strategy.TYPESAFE_REPLACE)
-    config_graphql = merge({}, __defaultgraphqlCmsConfig, configGraphQL,
-                           strategy=Strategy.TYPESAFE_REPLACE)
-    ytrelayPlaylistItemsAPI = config['ytrelayEndpoints']['playlistItems']
+    if resp.status_code < 200 or resp.status_code >= 300:
+        raise Exception(
+            f'ytrelayPlaylistItemsAPI has error({resp.status_code}):' + resp.text)
+
+    return resp.json()['items']
+
+
+def fetchNewPlaylistItems(relay: ytrelay.YtRelayClient, ytrelayPlaylistItemsAPI: str, playlistId: str, maxNumber: int, playlistState: dict, maxPages: int) -> tuple:
+    '''
+    fetchNewPlaylistItems follows the pageToken of the playlist until it reaches the newest video imported before, at most maxPages pages of maxNumber items.
+    The playlist is expected to list the latest video first, like the uploads of a channel.
+    The first page is requested with the ETag of the last run, so an unchanged playlist costs a 304 only.
+    When the pages run out before the newest imported video is reached, the newest imported video is kept and the next pageToken is saved,
+    so the next run resumes from there instead of losing the older videos of a burst.
+    It returns the new items and the state of the playlist for the next run.
+    '''
+    items = []
+    newState = dict(playlistState)
+    knownVideoId = playlistState.get('newestVideoId')
+    resuming = playlistState.get('resumePageToken') is not None
+    pageToken = playlistState.get('resumePageToken')
+    newestVideoId = playlistState.get('resumeNewestVideoId')
+    reachedKnownVideo = False
+    for page in range(maxPages):
+        params = dict(
+            part='snippet',
+            maxResults=maxNumber,
+            playlistId=playlistId,
+            fields='etag,nextPageToken,items(snippet/title,snippet/description,snippet/resourceId/videoId)'
+        )
+        headers = {}
+        if pageToken is not None:
+            params['pageToken'] = pageToken
+        elif playlistState.get('etag'):
+            headers['If-None-Match'] = playlistState['etag']
+        resp = relay.get(url=ytrelayPlaylistItemsAPI,
+                         params=params, headers=headers)
+
+        if resp.status_code == 304:
+            print(f'playlist({playlistId}) is not modified')
+            return [], playlistState
+        if resp.status_code < 200 or resp.status_code >= 300:
+            raise Exception(
+                f'ytrelayPlaylistItemsAPI has error({resp.status_code}):' + resp.text)
 
+        data = resp.json()
+        if page == 0 and not resuming:
+            newState['etag'] = resp.headers.get('ETag', data.get('etag'))
+            if len(data['items']) > 0:
+                newestVideoId = data['items'][0]['snippet']['resourceId']['videoId']
+
+        for item in data['items']:
+            if item['snippet']['resourceId']['videoId'] == knownVideoId:
+                reachedKnownVideo = True
+                break
+            items.append(item)
+
+        pageToken = data.get('nextPageToken')
+        if reachedKnownVideo or pageToken is None:
+            break
+
+    # a playlist synced for the first time has no known video, it starts from the pages read
+    if reachedKnownVideo or pageToken is None or knownVideoId is None:
+        newState.pop('resumePageToken', None)
+        newState.pop('resumeNewestVideoId', None)
+        if newestVideoId is not None:
+            newState['newestVideoId'] = newestVideoId
+        if resuming:
+            # the ETag is of the first page, which has not been read by this run
+            newState.pop('etag', None)
+    else:
+        print(
+            f'playlist({playlistId}) has more new videos than {maxPages} pages, the rest are fetched by the next run')
+        newState['resumePageToken'] = pageToken
+        newState['resumeNewestVideoId'] = newestVideoId
+        # the first page must be read again after the resumed pages, so it is not requested with the ETag
+        newState.pop('etag', None)
+
+    # the time of the last change decides the order and the page depth of the playlist in the next runs
+    if len(items) > 0:
+        newState['changedAt'] = time.time()
+    return items, newState
+
+
+def getYouTubeVideoId(url: str) -> str:
+    '''getYouTubeVideoId extracts the video id from the url of youtube.com or youtu.be'''
+    parsed_url = urlparse(url)
+    vqs = parse_qs(parsed_url.query).get('v', '')
+
+    if vqs:
+        return vqs[0]
+    else:
+        return parsed_url.path.split('/')[-1]
+
+
+def authenticate(configGraphQL: dict) -> str:
     # CMS get authentication token
     print(f'attempting to log in as CMS user:{configGraphQL["username"]}')
 
@@ -94,7 +188,10 @@ def main(config: dict = None, configGraphQL: dict = None, playlistIds: list = No
     token = gqlClient.execute(mutation)['authenticate']['token']
     print(
         f'{os.path.basename(__file__)} has authenticated as {configGraphQL["username"]}')
+    return token
+
 
+def createAuthenticatedClient(gqlEndpoint: str, token: str) -> Client:
     gqlTransportWithToken = RequestsHTTPTransport(
         url=gqlEndpoint,
         use_json=True,
@@ -106,61 +203,35 @@ def main(config: dict = None, configGraphQL: dict = None, playlistIds: list = No
         retries=3,
     )
 
-    gqlAuthenticatedClient = Client(
+    return Client(
         transport=gqlTransportWithToken,
         fetch_schema_from_transport=False,
     )
 
-    for playlistId in playlistIds:
-        params = dict(
-            part='snippet',
-            maxResults=maxNumber,
-            playlistId=playlistId,
-            fields='items(snippet/title,snippet/description,snippet/resourceId/videoId)'
-        )
-        headers = {'Cache-Set-TTL': '600'}
-        resp = requests.get(url=ytrelayPlaylistItemsAPI,
-                            params=params, headers=headers)
-
-        if resp.status_code < 200 or resp.status_code >= 300:
-            print(
-                f'ytrelayPlaylistItemsAPI has error({resp.status_code}):' + resp.text)
-            sys.exit(1)
-
-        data = resp.json()
-
-        # check videos' existence in CMS
-        items = [{'id': item['snippet']['resourceId']['videoId'], 'item': item}
-                 for item in data['items']]
 
-        # format query array
-        queryConditions = ','.join(
-            [f'''{{url_ends_with: "{item['id']}"}}''' for item in items])
-        query = gql(__queryExistingVideosTemplate % queryConditions)
+def createExistenceChecker(config: dict, gqlEndpoint: str, token: str) -> existence.ExistenceChecker:
+    '''createExistenceChecker creates the checker of the YouTube ids of the CMS videos with the existenceCheck config'''
+    return existence.from_config(lambda: createAuthenticatedClient(gqlEndpoint, token), config.get('existenceCheck'), list_name='allVideos', key_field='url',
+                                 condition=lambda ids: '{OR: [%s]}' % ','.join(
+                                     [f'{{url_ends_with: "{id}"}}' for id in ids]),
+                                 where=__youtubeVideosCondition, to_key=getYouTubeVideoId)
 
-        existingVideos = []
-        for video in gqlAuthenticatedClient.execute(query)['allVideos']:
-            parsed_url = urlparse(video['url'])
-            vqs = parse_qs(parsed_url.query).get('v', '')
 
-            if vqs:
-                existingVideos.append(vqs[0])
-            else:
-                existingVideos.append(parsed_url.path.split('/')[1])
+def createVideos(gqlAuthenticatedClient: Client, checker: existence.ExistenceChecker, items: dict, existingVideos: set):
+    '''createVideos creates the videos of the items not in existingVideos in one mutation'''
+    newVideoDataStrings = []
 
-        newVideoDataStrings = []
+    for videoId, item in items.items():
+        if videoId in existingVideos:
+            print(f'Video({videoId}) is in CMS. Skip it.')
+            continue
 
-        for item in items:
-            if item['id'] in existingVideos:
-                print(f'Video({item["id"]}) is in CMS. Skip it.')
-                continue
-
-            # save new video to CMS
-            snippet = item['item']['snippet']
+        # save new video to CMS
+        snippet = item['snippet']
 
 # Commented because the editors mey request feature of Post creation in the future
-            # brief = convertTextToDraft(config, snippet['description'])
-            # print(f'convert [{snippet["title"]}] brief to:\n{brief}')
+        # brief = convertTextToDraft(config, snippet['description'])
+        # print(f'convert [{snippet["title"]}] brief to:\n{brief}')
 #             insertMutationStr = f'''
 # mutation {{
 #     createPost(data: {{
@@ -195,39 +266,113 @@ def main(config: dict = None, configGraphQL: dict = None, playlistIds: list = No
 #             else:
 #                 print(f'[Error] {result["errors"]}')
 
-            # we create the videos only
-            videoGql = f'''{{
-                data: {{
-                    state: draft,
-                    youtubeUrl: {json.dumps('https://www.youtube.com/watch?v=' + snippet['resourceId']['videoId'], ensure_ascii=False)},
-                    name: {json.dumps(snippet['title'], ensure_ascii=False)}
-                }}
+        # we create the videos only
+        videoGql = f'''{{
+            data: {{
+                state: draft,
+                youtubeUrl: {json.dumps('https://www.youtube.com/watch?v=' + snippet['resourceId']['videoId'], ensure_ascii=False)},
+                name: {json.dumps(snippet['title'], ensure_ascii=False)}
             }}
-            '''
+        }}
+        '''
 
-            newVideoDataStrings.append(videoGql)
+        newVideoDataStrings.append(videoGql)
 
-        if len(newVideoDataStrings) != 0:
-            createVideosMutationStr = '''
-            mutation {
-                createVideos(data:[%s]){
-                    id
-                    name
-                }
+    if len(newVideoDataStrings) != 0:
+        createVideosMutationStr = '''
+        mutation {
+            createVideos(data:[%s]){
+                id
+                name
             }
-            ''' % ', '.join(newVideoDataStrings)
-
-            result = gqlAuthenticatedClient.execute(
-                gql(createVideosMutationStr))
-
-            if 'errors' not in result:
-                newItems = [{'id': video['id'], 'name': video['name']}
-                            for video in result["createVideos"]]
-                print(
-                    f'created {newItems}')
-            else:
-                print(f'[Error] {result["errors"]}')
-                sys.exit(1)
+        }
+        ''' % ', '.join(newVideoDataStrings)
+
+        result = gqlAuthenticatedClient.execute(
+            gql(createVideosMutationStr))
+
+        if 'errors' not in result:
+            newItems = [{'id': video['id'], 'name': video['name']}
+                        for video in result["createVideos"]]
+            print(
+                f'created {newItems}')
+            checker.add(list(items.keys()))
+        else:
+            print(f'[Error] {result["errors"]}')
+            sys.exit(1)
+
+
+def main(config: dict = None, configGraphQL: dict = None, playlistIds: list = None, maxNumber: int = 3, token: str = None):
+    ''' Import YouTube Channel program starts here. The login is skipped when the token is given, e.g. by the scheduler. '''
+    print(f'{__file__} is executing...')
+
+    # merge option to the default configs
+    config = merge({}, __defaultConfig, config,
+                   strategy=Strategy.TYPESAFE_REPLACE)
+    config_graphql = merge({}, __defaultgraphqlCmsConfig, configGraphQL,
+                           strategy=Strategy.TYPESAFE_REPLACE)
+    ytrelayPlaylistItemsAPI = config['ytrelayEndpoints']['playlistItems']
+
+    # fetch the playlists concurrently, a video in several playlists is imported once
+    # with incrementalSync, only the videos after the newest imported one are fetched
+    syncConfig = config.get('incrementalSync')
+    syncState = job_state.load(syncConfig, {}) if syncConfig else None
+
+    # the playlists changed most recently are fetched first and deeper, the rest wait for the next run once the quota budget is spent
+    relay = ytrelay.YtRelayClient(quotaBudget=config.get(
+        'quotaBudget'), cacheTTL=config['cacheTTL'], poolSize=config['concurrency'])
+    if syncState is None:
+        plans = [(playlistId, 1) for playlistId in playlistIds]
+    else:
+        plans = ytrelay.planPlaylists(
+            playlistIds, syncState, syncConfig.get('maxPages', 10), time.time())
+
+    def fetch(playlistId: str, pages: int) -> list:
+        if syncState is None:
+            return fetchPlaylistItems(relay, ytrelayPlaylistItemsAPI, playlistId, maxNumber)
+        playlistItems, syncState[playlistId] = fetchNewPlaylistItems(
+            relay, ytrelayPlaylistItemsAPI, playlistId, maxNumber, syncState.get(playlistId, {}), pages)
+        return playlistItems
+
+    items = {}
+    failedPlaylistIds = []
+    with ThreadPoolExecutor(max_workers=config['concurrency']) as executor:
+        futures = [executor.submit(fetch, playlistId, pages)
+                   for playlistId, pages in plans]
+        for (playlistId, _), future in zip(plans, futures):
+            try:
+                playlistItems = future.result()
+            except ytrelay.QuotaExceeded as e:
+                print(f'playlist({playlistId}) is left to the next run: {e}')
+                continue
+            except Exception as e:
+                print(f'playlist({playlistId}) failed: {e}')
+                failedPlaylistIds.append(playlistId)
+                continue
+            for item in playlistItems:
+                items.setdefault(item['snippet']['resourceId']['videoId'], item)
+    relay.close()
+
+    if len(items) == 0:
+        print('there is no new video in the playlists')
+    else:
+        if token is None:
+            token = authenticate(configGraphQL)
+        gqlAuthenticatedClient = createAuthenticatedClient(
+            configGraphQL['apiEndpoint'], token)
+        checker = createExistenceChecker(
+            config, configGraphQL['apiEndpoint'], token)
+        # check videos' existence in CMS
+        existingVideos = checker.find_existing(list(items.keys()))
+        createVideos(gqlAuthenticatedClient, checker, items, existingVideos)
+        checker.save()
+        checker.close()
+
+    if syncState is not None:
+        job_state.save(syncConfig, syncState)
+
+    if len(failedPlaylistIds) != 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+from requests.adapters import HTTPAdapter
+import requests
+import threading
+
+# the YouTube Data API charges every playlistItems.list call one unit, the relay cannot tell whether its cache answered
+PLAYLIST_ITEMS_QUOTA_COST = 1
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class YtRelayClient:
+    '''
+    YtRelayClient sends the requests of a run to yt-relay through one pooled session.
+    Every request is charged to the quota budget of the run, which raises QuotaExceeded once it is spent.
+    '''
+
+    def __init__(self, quotaBudget: int = None, cacheTTL: int = 600, poolSize: int = 8):
+        self.quotaBudget = quotaBudget
+        self.quotaUsed = 0
+        self.cacheTTL = cacheTTL
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+
+    def spend(self, units: int):
+        with self.lock:
+            if self.quotaBudget is not None and self.quotaUsed + units > self.quotaBudget:
+                raise QuotaExceeded(
+                    f'quota budget({self.quotaBudget}) of this run is spent')
+            self.quotaUsed += units
+
+    def get(self, url: str, params: dict, headers: dict = None) -> requests.Response:
+        headers = dict(headers or {})
+        headers.setdefault('Cache-Set-TTL', str(self.cacheTTL))
+        self.spend(PLAYLIST_ITEMS_QUOTA_COST)
+        return self.session.get(url=url, params=params, headers=headers)
+
+    def close(self):
+        print(f'[{__name__}] used {self.quotaUsed} units of quota')
+        self.session.close()
+
+
+def planPlaylists(playlistIds: list, syncState: dict, maxPages: int, now: float) -> list:
+    '''
+    planPlaylists orders the playlists by how recently they changed and gives each of them a page depth,
+    so the quota budget goes to the playlists which change most. A playlist never synced before, or still catching up with a burst, comes first with the full depth.
+    A shallow depth never loses videos, fetchNewPlaylistItems saves where it stopped and the next run resumes from there.
+    It returns the list of (playlistId, pages).
+    '''
+    plans = []
+    for playlistId in dict.fromkeys(playlistIds):
+        playlistState = syncState.get(playlistId, {})
+        changedAt = playlistState.get('changedAt')
+        if changedAt is None or playlistState.get('resumePageToken') is not None:
+            plans.append((float('inf'), playlistId, maxPages))
+            continue
+        age = now - changedAt
+        if age < 24 * 60 * 60:
+            pages = maxPages
+        elif age < 7 * 24 * 60 * 60:
+            pages = max(maxPages // 2, 1)
+        else:
+            pages = 1
+        plans.append((-age, playlistId, pages))
+    return [(playlistId, pages) for _, playlistId, pages in sorted(plans, key=lambda plan: plan[0], reverse=True)]
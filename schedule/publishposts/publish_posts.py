@@ -1,36 +1,44 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from dateutil import parser
 from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
 import argparse
+import heapq
 import logging
 import os
+import threading
+import time
 import yaml
 
 
 logging.basicConfig()
 
 
-def main(config_graphql: dict = None):
-    ''' Import YouTube Channel program starts here '''
-    logger = logging.getLogger(__file__)
-    logger.setLevel('INFO')
+def create_client(cms_graphql_endpoint: str, token: str = None) -> Client:
+    headers = {
+        "Content-type": "application/json",
+    }
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
 
-    cms_graphql_endpoint = config_graphql['apiEndpoint']
     gql_transport = RequestsHTTPTransport(
         url=cms_graphql_endpoint,
         use_json=True,
-        headers={
-            "Content-type": "application/json",
-        },
+        headers=headers,
         verify=True,
         retries=3,
     )
 
-    gql_client = Client(
+    return Client(
         transport=gql_transport,
         fetch_schema_from_transport=False,
     )
 
+
+def authenticate(config_graphql: dict) -> str:
+    gql_client = create_client(config_graphql['apiEndpoint'])
+
     # Authenticate through GraphQL
     qgl_mutation_authenticate_get_token = '''
     mutation {
@@ -49,77 +57,187 @@ def main(config_graphql: dict = None):
 
     print(f'{os.path.basename(__file__)} has authenticated as {username}')
 
-    gql_transport_with_token = RequestsHTTPTransport(
-        url=cms_graphql_endpoint,
-        use_json=True,
-        headers={
-            "Content-type": "application/json",
-            'Authorization': f'Bearer {token}'
-        },
-        verify=True,
-        retries=3,
-    )
+    return token
 
-    gql_authenticated_client = Client(
-        transport=gql_transport_with_token,
-        fetch_schema_from_transport=False,
-    )
+
+def fetch_due_ids(gql_authenticated_client: Client, list_name: str, now: str, page_size: int) -> list:
+    '''fetch_due_ids pages through the ids of the scheduled items of the list whose publishTime is before now'''
+    query_scheduled_template = '''
+    {
+        %s(where: {state: scheduled, publishTime_lte: "%s"}, sortBy: id_ASC, first: %d, skip: %d) {
+            id
+        }
+    }
+    '''
+
+    ids = []
+    while True:
+        page = gql_authenticated_client.execute(gql(query_scheduled_template % (
+            list_name, now, page_size, len(ids))))[list_name]
+        ids.extend([item['id'] for item in page])
+        if len(page) < page_size:
+            return ids
+
+
+def publish_chunk(gql_authenticated_client: Client, mutation_name: str, ids: list, now: str, retries: int) -> list:
+    '''publish_chunk publishes the items of one chunk by one mutation, and tries it again up to retries times'''
+    data = ['{id: %s, data:{state: published, publishTime: "%s"}}' % (id, now)
+            for id in ids]
+    publish_mutation = '''
+    mutation {
+        %s(data: [%s]){
+            id
+            name
+            state
+        }
+    }
+    ''' % (mutation_name, ' ,'.join(data))
+
+    for attempt in range(retries + 1):
+        try:
+            return gql_authenticated_client.execute(gql(publish_mutation))[mutation_name]
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def publish_due_items(config_graphql: dict, token: str, page_size: int = 100, chunk_size: int = 50, parallelism: int = 4, retries: int = 2) -> dict:
+    '''
+    publish_due_items publishes all the scheduled posts and art shows whose publishTime has come.
+    The ids are fetched page by page and published in chunks of chunk_size concurrently, so a large backlog never becomes one huge request
+    and a failed chunk does not block the others. It returns the numbers of the published items of each mutation,
+    and raises after all the chunks are done when any of them has failed.
+    '''
+    logger = logging.getLogger(__file__)
+    logger.setLevel('INFO')
 
     now = datetime.utcnow().isoformat(timespec='microseconds') + "Z"
 
-    query_scheduled_posts = '''
+    # gql clients are not thread-safe, so every worker has its own client with the same token
+    local = threading.local()
+
+    def get_client() -> Client:
+        if not hasattr(local, 'client'):
+            local.client = create_client(config_graphql['apiEndpoint'], token)
+        return local.client
+
+    chunks = []
+    for list_name, mutation_name in [('allPosts', 'updatePosts'), ('allArtShows', 'updateArtShows')]:
+        ids = fetch_due_ids(get_client(), list_name, now, page_size)
+        chunks.extend([(mutation_name, ids[i:i + chunk_size])
+                       for i in range(0, len(ids), chunk_size)])
+
+    counts = {'updatePosts': {'published': 0, 'failed': 0},
+              'updateArtShows': {'published': 0, 'failed': 0}}
+    if len(chunks) == 0:
+        logger.info('there is no scheduled post ready to be published')
+        return counts
+
+    def publish(mutation_name: str, ids: list) -> list:
+        return publish_chunk(get_client(), mutation_name, ids, now, retries)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [executor.submit(publish, mutation_name, ids)
+                   for mutation_name, ids in chunks]
+        for index, ((mutation_name, ids), future) in enumerate(zip(chunks, futures)):
+            try:
+                updated_items = future.result()
+            except Exception as e:
+                counts[mutation_name]['failed'] += len(ids)
+                logger.error(
+                    f'chunk({index}) of {mutation_name} failed to publish {len(ids)} items: {repr(e)}')
+                continue
+            counts[mutation_name]['published'] += len(updated_items)
+            logger.info(
+                f'chunk({index}) of {mutation_name} published {len(updated_items)} of {len(ids)} items')
+            for item in updated_items:
+                logger.info(
+                    f'post(id: {item["id"]}) {item["name"]} is {item["state"]}')
+
+    logger.info(f'published items: {counts}')
+    failed = sum([count['failed'] for count in counts.values()])
+    if failed > 0:
+        raise Exception(f'failed to publish {failed} scheduled items: {counts}')
+    return counts
+
+
+def fetch_upcoming_publish_times(gql_authenticated_client: Client, until: datetime) -> list:
+    '''fetch_upcoming_publish_times returns the publishTime of the scheduled posts and art shows which are due before until'''
+    query_upcoming = '''
     {
         allPosts(where: {state: scheduled, publishTime_lte: "%s"}) {
-            id
+            publishTime
         }
         allArtShows(where:{ state: scheduled, publishTime_lte: "%s"}) {
-            id
+            publishTime
         }
     }
-    ''' % (now, now)
-
-    resp = gql_authenticated_client.execute(
-        gql(query_scheduled_posts))
-    all_posts = resp['allPosts']
-    all_art_shows = resp['allArtShows']
-
-    post_data = ['{id: %s, data:{state: published, publishTime: "%s"}}' % (post['id'], now)
-                 for post in all_posts]
-
-    art_show_data = ['{id: %s, data:{state: published, publishTime: "%s"}}' % (art_show['id'], now)
-                     for art_show in all_art_shows]
-
-    if len(post_data) != 0 or len(art_show_data) != 0:
-        publish_mutation = '''
-        mutation {
-            updatePosts(data: [%s]){
-                id
-                name
-                state
-            }
-            updateArtShows(data: [%s]){
-                id
-                name
-                state
-            }
-        }
-        ''' % (' ,'.join(post_data), ' ,'.join(art_show_data))
+    ''' % ((until.isoformat(timespec='microseconds') + "Z",) * 2)
+
+    resp = gql_authenticated_client.execute(gql(query_upcoming))
+    # publishTime keeps its stored offset, e.g. +08:00, so it is converted to the naive UTC of utcnow()
+    return [parser.isoparse(item['publishTime']).astimezone(timezone.utc).replace(tzinfo=None)
+            for item in resp['allPosts'] + resp['allArtShows'] if item['publishTime'] is not None]
 
-        resp = gql_authenticated_client.execute(
-            gql(publish_mutation))
-        updated_posts = resp['updatePosts']
-        for post in updated_posts:
-            logger.info(
-                f'post(id: {post["id"]}) {post["name"]} is {post["state"]}')
-        updated_art_shows = resp['updateArtShows']
-        for art_show in updated_art_shows:
-            logger.info(
-                f'post(id: {art_show["id"]}) {art_show["name"]} is {art_show["state"]}')
-    else:
-        logger.info('there is no scheduled post ready to be published')
+
+def watch(config_graphql: dict, resync_interval: int = 60, **publish_options):
+    '''
+    watch keeps the publishTime of the upcoming scheduled items in a timer heap and publishes them as soon as they are due.
+    The heap is rebuilt every resync_interval seconds, so rescheduled or unscheduled items are picked up.
+    The items due at the same time are published together.
+    '''
+    logger = logging.getLogger(__file__)
+    logger.setLevel('INFO')
+
+    token = None
+    timers = []
+    next_resync = datetime.utcnow()
+    while True:
+        try:
+            if token is None:
+                token = authenticate(config_graphql)
+                gql_authenticated_client = create_client(
+                    config_graphql['apiEndpoint'], token)
+            now = datetime.utcnow()
+            if now >= next_resync:
+                # the items due before the next resync are enough, the later ones are loaded by the following resyncs
+                next_resync = now + timedelta(seconds=resync_interval)
+                timers = fetch_upcoming_publish_times(
+                    gql_authenticated_client, next_resync + timedelta(seconds=resync_interval))
+                heapq.heapify(timers)
+                logger.info(
+                    f'{len(timers)} scheduled items are due in {resync_interval * 2} seconds')
+
+            if len(timers) > 0 and timers[0] <= now:
+                while len(timers) > 0 and timers[0] <= now:
+                    heapq.heappop(timers)
+                publish_due_items(config_graphql, token, **publish_options)
+                continue
+
+            wake_up = min(timers[0], next_resync) if len(
+                timers) > 0 else next_resync
+            time.sleep(max((wake_up - datetime.utcnow()).total_seconds(), 0))
+        except Exception as e:
+            # the token may have expired, so the login is done again before the next try
+            logger.error(f'watching scheduled items failed: {repr(e)}')
+            time.sleep(1)
+            token = None
+            next_resync = datetime.utcnow()
+
+
+def main(config_graphql: dict = None, chunk_size: int = 50, parallelism: int = 4, token: str = None) -> dict:
+    ''' Import YouTube Channel program starts here. The login is skipped when the token is given, e.g. by the scheduler. '''
+    if token is None:
+        token = authenticate(config_graphql)
+    return publish_due_items(config_graphql, token, chunk_size=chunk_size, parallelism=parallelism)
 
 
 __GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
+__WATCH_KEY = 'watch'
+__RESYNC_INTERVAL_KEY = 'resyncInterval'
+__CHUNK_SIZE_KEY = 'chunkSize'
+__PARALLELISM_KEY = 'parallelism'
 
 if __name__ == '__main__':
     logger = logging.getLogger(__file__)
@@ -129,12 +247,26 @@ if __name__ == '__main__':
         description=f'Process configuration of {__file__}')
     parser.add_argument('-g', '--config-graphql', dest=__GRAPHQL_CMS_CONFIG_KEY,
                         help=f'graphql config file for {__file__} ', metavar='FILE', type=str, required=True)
+    parser.add_argument('-w', '--watch', dest=__WATCH_KEY, action='store_true',
+                        help='keep running and publish the scheduled items at their publishTime')
+    parser.add_argument('-r', '--resync-interval', dest=__RESYNC_INTERVAL_KEY,
+                        help='seconds between the resyncs of the upcoming scheduled items in the watch mode', metavar='60', type=int, default=60)
+    parser.add_argument('-s', '--chunk-size', dest=__CHUNK_SIZE_KEY,
+                        help='number of items published by one mutation', metavar='50', type=int, default=50)
+    parser.add_argument('-p', '--parallelism', dest=__PARALLELISM_KEY,
+                        help='number of mutations sent concurrently', metavar='4', type=int, default=4)
 
     args = parser.parse_args()
 
     with open(getattr(args, __GRAPHQL_CMS_CONFIG_KEY), 'r') as stream:
         config_graphql = yaml.safe_load(stream)
 
-    main(config_graphql=config_graphql)
+    if getattr(args, __WATCH_KEY):
+        watch(config_graphql=config_graphql,
+              resync_interval=getattr(args, __RESYNC_INTERVAL_KEY),
+              chunk_size=getattr(args, __CHUNK_SIZE_KEY), parallelism=getattr(args, __PARALLELISM_KEY))
+    else:
+        main(config_graphql=config_graphql, chunk_size=getattr(
+            args, __CHUNK_SIZE_KEY), parallelism=getattr(args, __PARALLELISM_KEY))
 
     logger.info('exiting...good bye...')
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
 
@@ -6,6 +7,8 @@ import argparse
 import logging
 import os
 import sys
+import threading
+import time
 import yaml
 
 '''
@@ -24,23 +27,30 @@ def get_updated_state(state: str = 'draft') -> str:
         return state
 
 
-def create_authenticated_client(config_graphql: dict):
-    cms_graphql_endpoint = config_graphql['apiEndpoint']
+def create_client(cms_graphql_endpoint: str, token: str = None) -> Client:
+    headers = {
+        "Content-type": "application/json",
+    }
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
+
     gql_transport = RequestsHTTPTransport(
         url=cms_graphql_endpoint,
         use_json=True,
-        headers={
-            "Content-type": "application/json",
-        },
+        headers=headers,
         verify=True,
         retries=3,
     )
 
-    gql_client = Client(
+    return Client(
         transport=gql_transport,
         fetch_schema_from_transport=False,
     )
 
+
+def authenticate(config_graphql: dict) -> str:
+    gql_client = create_client(config_graphql['apiEndpoint'])
+
     # Authenticate through GraphQL
     qgl_mutation_authenticate_get_token = '''
     mutation {
@@ -60,21 +70,7 @@ def create_authenticated_client(config_graphql: dict):
 
     print(f'{os.path.basename(__file__)} has authenticated as {username}')
 
-    gql_transport_with_token = RequestsHTTPTransport(
-        url=cms_graphql_endpoint,
-        use_json=True,
-        headers={
-            "Content-type": "application/json",
-            'Authorization': f'Bearer {token}'
-        },
-        verify=True,
-        retries=3,
-    )
-
-    return Client(
-        transport=gql_transport_with_token,
-        fetch_schema_from_transport=False,
-    )
+    return token
 
 
 def unauthenticate_graphql_user(gql_authenticated_client: Client, username: str):
@@ -96,91 +92,125 @@ def unauthenticate_graphql_user(gql_authenticated_client: Client, username: str)
         print(f'{username} failed to unauthenticate')
 
 
-def update_multiple_states(client: Client, mutation_name: str, content: list):
+# The list query and the update mutation of each rotated type
+__rotated_types__ = [
+    ('allEditorChoices', 'updateEditorChoices'),
+    ('allVideoEditorChoices', 'updateVideoEditorChoices'),
+    ('allPromotionVideos', 'updatePromotionVideos'),
+]
 
-    new_data_list = ['{id: "%s", data:{state: %s}}' % (
-        data["id"], get_updated_state(data["state"])) for data in content]
-    new_data_str = '[' + ','.join(new_data_list) + ']'
 
-    print(f'{mutation_name} is going to update: {new_data_str}')
+def fetch_contents_to_rotate(client: Client, page_size: int) -> dict:
+    '''fetch_contents_to_rotate pages through the published and scheduled items of all the rotated types, one query per page for all the types'''
+    where_condition = '{OR: [{state: published}, {state: scheduled}]}'
+    qgl_query_list_template = '''
+        %s(where: %s, sortBy: id_ASC, first: %d, skip: %d) {
+            state
+            id
+        }
+    '''
 
-    qgl_mutate_editor_choices_template = '''
-        mutation {
-            %s(data: %s) {
+    contents = {list_name: [] for list_name, _ in __rotated_types__}
+    unfinished = list(contents.keys())
+    skip = 0
+    while len(unfinished) > 0:
+        query = '{%s}' % ''.join([qgl_query_list_template % (
+            list_name, where_condition, page_size, skip) for list_name in unfinished])
+        page = client.execute(gql(query))
+        for list_name in list(unfinished):
+            contents[list_name].extend(page[list_name])
+            if len(page[list_name]) < page_size:
+                unfinished.remove(list_name)
+        skip += page_size
+    return contents
+
+
+def update_multiple_states(client: Client, chunks: list) -> dict:
+    '''update_multiple_states rotates the states of the chunks of different types in one mutation, every chunk is an aliased update'''
+    qgl_mutate_template = '''
+            %s: %s(data: %s) {
                 id
                 state
             }
-        }
     '''
 
-    mutation = gql(
-        qgl_mutate_editor_choices_template % (mutation_name, new_data_str)
-    )
-
-    updatedData = client.execute(mutation)
-
-    print(f'{mutation_name} updated:{updatedData}')
+    aliases = []
+    for mutation_name, content in chunks:
+        new_data_list = ['{id: "%s", data:{state: %s}}' % (
+            data["id"], get_updated_state(data["state"])) for data in content]
+        aliases.append(qgl_mutate_template % (
+            f'{mutation_name}{len(aliases)}', mutation_name, '[' + ','.join(new_data_list) + ']'))
 
-    return updatedData
+    updated_data = client.execute(
+        gql('mutation {%s}' % ''.join(aliases)))
+    return {f'{mutation_name}{i}': updated_data[f'{mutation_name}{i}'] for i, (mutation_name, _) in enumerate(chunks)}
 
 
-def rotate_and_update_states(client: Client):
-
-    where_condition = '{OR: [{state: published}, {state: scheduled}]}'
-
-    qgl_query_content_to_modify = '''
-    {
-        allEditorChoices(where: %s) {
-            state
-            id
-        }
-        allVideoEditorChoices(where: %s) {
-            state
-            id
-        }
-        allPromotionVideos(where: %s) {
-            state
-            id
-        }
-    }
-    ''' % (where_condition, where_condition, where_condition)
-
-    content = client.execute(gql(qgl_query_content_to_modify))
-
-    editor_choices = content['allEditorChoices']
-    if len(editor_choices) != 0:
-        update_multiple_states(client, 'updateEditorChoices', editor_choices)
-    else:
-        print('There is nothing to be updated for EditorChoice')
-
-    video_editor_choices = content['allVideoEditorChoices']
-    if len(video_editor_choices) != 0:
-        update_multiple_states(
-            client, 'updateVideoEditorChoices', video_editor_choices)
-    else:
-        print('There is nothing to be updated for VideoEditorChoice')
-
-    promotion_videos = content['allPromotionVideos']
-    if len(promotion_videos) != 0:
-        update_multiple_states(
-            client, 'updatePromotionVideos', promotion_videos)
-    else:
-        print('There is nothing to be updated for PromotionVideo')
+def rotate_and_update_states(config_graphql: dict, token: str, page_size: int = 500, chunk_size: int = 100, parallelism: int = 4) -> dict:
+    '''
+    rotate_and_update_states rotates the states of editor choices, video editor choices and promotion videos.
+    The i-th chunks of all the types are sent together as one aliased mutation, so the usual rotation takes one round trip,
+    and the mutations of larger lists are sent concurrently. It returns the count and the latency of each type.
+    '''
+    # gql clients are not thread-safe, so every worker has its own client with the same token
+    local = threading.local()
+
+    def get_client() -> Client:
+        if not hasattr(local, 'client'):
+            local.client = create_client(config_graphql['apiEndpoint'], token)
+        return local.client
+
+    contents = fetch_contents_to_rotate(get_client(), page_size)
+
+    stats = {}
+    batches = []
+    for list_name, mutation_name in __rotated_types__:
+        content = contents[list_name]
+        stats[mutation_name] = {'count': 0, 'latencyMs': 0}
+        if len(content) == 0:
+            print(f'There is nothing to be updated for {mutation_name[len("update"):-1]}')
+        for i, start in enumerate(range(0, len(content), chunk_size)):
+            if i == len(batches):
+                batches.append([])
+            batches[i].append((mutation_name, content[start:start + chunk_size]))
+
+    def update(chunks: list) -> tuple:
+        start = time.perf_counter()
+        updated_data = update_multiple_states(get_client(), chunks)
+        return updated_data, round((time.perf_counter() - start) * 1000)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for chunks, (updated_data, latency) in zip(batches, executor.map(update, batches)):
+            for mutation_name, _ in chunks:
+                stats[mutation_name]['latencyMs'] = max(
+                    stats[mutation_name]['latencyMs'], latency)
+            for alias, updated_items in updated_data.items():
+                stats[alias.rstrip('0123456789')]['count'] += len(updated_items)
+
+    for mutation_name, stat in stats.items():
+        print(f'{mutation_name} updated {stat["count"]} items in {stat["latencyMs"]}ms')
+    return stats
 
 
 __GRAPHQL_CMS_CONFIG_KEY = 'graphqlCMS'
 
 
-def main(config_graphql: dict = None):
+def main(config_graphql: dict = None, token: str = None):
+    '''main rotates the states. The login is skipped when the token is given, e.g. by the scheduler, and the given token is not signed out as others share it.'''
     logger = logging.getLogger(__main__.__file__)
     logger.setLevel('INFO')
 
-    authenticated_gql_client = create_authenticated_client(config_graphql)
+    signout = token is None
+    if signout:
+        token = authenticate(config_graphql)
+
+    stats = rotate_and_update_states(config_graphql, token)
 
-    rotate_and_update_states(authenticated_gql_client)
+    if signout:
+        unauthenticate_graphql_user(
+            create_client(config_graphql['apiEndpoint'], token), config_graphql['username'])
 
-    unauthenticate_graphql_user(
-        authenticated_gql_client, config_graphql['username'])
+    return stats
 
 
 logging.basicConfig()